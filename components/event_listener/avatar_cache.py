@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# QQ头像下载地址
+AVATAR_URL_TEMPLATE = "http://q1.qlogo.cn/g?b=qq&nk={qq_id}&s=100"
+
+# 头像缓存的默认容量、有效期和失败结果的有效期（秒）
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_TTL = 3600.0
+DEFAULT_NEGATIVE_TTL = 60.0
+# 下载失败（连接错误或5xx）时的重试次数
+DEFAULT_RETRIES = 1
+_RETRY_DELAY = 0.2
+
+# 负缓存条目没有数据，按固定开销计入容量，避免无限增长
+_NEGATIVE_ENTRY_COST = 64
+
+
+class AvatarCache:
+    """按QQ号缓存头像的LRU缓存，按总字节数限制容量，支持TTL和负缓存"""
+
+    def __init__(self, client, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL, url_template=AVATAR_URL_TEMPLATE, retries=DEFAULT_RETRIES):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.url_template = url_template
+        self.retries = retries
+        # qq_id -> (过期时间, 头像数据或None)
+        self._entries = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.errors = 0
+        self.evictions = 0
+
+    def _entry_cost(self, data):
+        return len(data) if data is not None else _NEGATIVE_ENTRY_COST
+
+    def _lookup(self, key):
+        """查询缓存，返回 (是否命中, 数据)"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, data = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            return False, None
+        self._entries.move_to_end(key)
+        return True, data
+
+    def _remove(self, key):
+        _, data = self._entries.pop(key)
+        self._size -= self._entry_cost(data)
+
+    def _store(self, key, data):
+        if key in self._entries:
+            self._remove(key)
+        cost = self._entry_cost(data)
+        if cost > self.max_bytes:
+            return
+        ttl = self.ttl if data is not None else self.negative_ttl
+        self._entries[key] = (time.monotonic() + ttl, data)
+        self._size += cost
+        # 超出容量时淘汰最久未使用的条目
+        while self._size > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    async def _download(self, qq_id):
+        img_url = self.url_template.format(qq_id=qq_id)
+        for attempt in range(self.retries + 1):
+            try:
+                img_resp = await self.client.get(img_url)
+                img_resp.raise_for_status()
+                return img_resp.content
+            except Exception as e:
+                # 连接错误和服务端错误可以重试（GET请求是幂等的）
+                retryable = isinstance(e, httpx.TransportError) or (
+                    isinstance(e, httpx.HTTPStatusError) and e.response.status_code >= 500
+                )
+                if retryable and attempt < self.retries:
+                    await asyncio.sleep(_RETRY_DELAY)
+                    continue
+                self.errors += 1
+                logger.error(f"获取QQ头像时出错（{qq_id}）：{repr(e)}")
+                return None
+
+    async def get(self, qq_id):
+        """
+        获取头像
+        :param qq_id: QQ号
+        :return: 头像二进制数据，获取失败时返回None
+        """
+        key = str(qq_id)
+        hit, data = self._lookup(key)
+        if hit:
+            if data is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return data
+
+        self.misses += 1
+        data = await self._download(key)
+        # 失败结果也写入缓存（较短TTL），避免反复请求失败的QQ号
+        self._store(key, data)
+        return data
+
+    async def get_many(self, *qq_ids):
+        """
+        并发获取多个头像，相同QQ号只下载一次
+        :return: 与参数顺序一致的头像列表，None参数对应None结果
+        """
+        unique_ids = list(dict.fromkeys(str(i) for i in qq_ids if i is not None))
+        results = await asyncio.gather(*(self.get(i) for i in unique_ids))
+        avatars = dict(zip(unique_ids, results))
+        return [avatars.get(str(i)) if i is not None else None for i in qq_ids]
+
+    def stats(self):
+        """返回缓存统计信息"""
+        return {
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'evictions': self.evictions,
+        }
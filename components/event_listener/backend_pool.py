@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import random
+import re
+import time
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMEURL = "http://127.0.0.1:2233"
+# 连续失败多少次后熔断
+DEFAULT_FAILURE_THRESHOLD = 3
+# 熔断后多久允许一次试探请求（秒）
+DEFAULT_RESET_TIMEOUT = 30.0
+# 主动健康检查间隔（秒），0表示不检查
+DEFAULT_HEALTH_INTERVAL = 10.0
+HEALTH_PATH = '/meme/version'
+_HEALTH_TIMEOUT = 3.0
+# 所有后端都失败后重试前的等待时间（秒），按次数指数增长
+_RETRY_BACKOFF = 0.2
+
+# 网关类错误说明后端实例不可用，可以换一个实例重试；
+# meme-generator 用其他 5xx（如 510~560）表示表情包本身的错误，换实例也没用
+FAILOVER_STATUS_CODES = frozenset((502, 503, 504))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class NoBackendAvailableError(RuntimeError):
+    """所有后端都已熔断或不健康"""
+
+    def __init__(self):
+        super().__init__("表情包后端暂时不可用，请稍后再试")
+
+
+def parse_backend_urls(value):
+    """
+    解析 memeurl 配置：单个URL、逗号/空白分隔的多个URL，或URL列表
+    :return: 去重后的URL列表（去掉末尾的 /）
+    """
+    if not value:
+        return []
+    items = value if isinstance(value, (list, tuple)) else re.split(r'[\s,;]+', str(value))
+    urls = []
+    for item in items:
+        url = str(item).strip().rstrip('/')
+        if url and url not in urls:
+            urls.append(url)
+    return urls
+
+
+def is_failover_error(exc):
+    """连接/超时错误和网关错误可以切换到其他后端重试"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in FAILOVER_STATUS_CODES
+    return isinstance(exc, httpx.TransportError)
+
+
+class Backend:
+    """单个后端实例的负载和熔断状态"""
+
+    __slots__ = (
+        'url', 'outstanding', 'state', 'consecutive_failures', 'opened_at',
+        'healthy', 'requests', 'failures', 'trips',
+    )
+
+    def __init__(self, url):
+        self.url = url
+        # 进行中的请求数
+        self.outstanding = 0
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        # 最近一次健康检查结果
+        self.healthy = True
+        self.requests = 0
+        self.failures = 0
+        self.trips = 0
+
+
+class BackendPool:
+    """
+    多个表情包后端：按进行中请求数最少路由，连续失败时熔断，
+    网关/连接错误时透明切换到其他后端
+    """
+
+    def __init__(self, urls, client=None, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, health_interval=DEFAULT_HEALTH_INTERVAL):
+        """
+        :param urls: 后端URL列表，为空时使用默认地址
+        :param client: 共享的HTTP客户端，用于健康检查
+        """
+        self.backends = [Backend(url) for url in (urls or [DEFAULT_MEMEURL])]
+        self.client = client
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self.health_interval = health_interval
+        self._rotation = 0
+        self._task = None
+        self.failovers = 0
+        self.retries = 0
+
+    def __len__(self):
+        return len(self.backends)
+
+    @property
+    def primary_url(self):
+        """当前最适合的后端地址（不占用请求计数），用于获取表情包目录等非渲染请求"""
+        backend = self._pick(set(), probe=False)
+        return (backend or self.backends[0]).url
+
+    def _available(self, backend, now, probe):
+        if backend.state == CLOSED:
+            return True
+        if backend.state == OPEN and now - backend.opened_at >= self.reset_timeout:
+            # 熔断超时：允许一次试探请求（半开）
+            if probe:
+                backend.state = HALF_OPEN
+            return True
+        return False
+
+    def _pick(self, tried, probe=True):
+        """选择进行中请求最少的可用后端；健康检查失败的后端只在没有其他选择时使用"""
+        now = time.monotonic()
+        count = len(self.backends)
+        # 轮转起点，负载相同时把请求分散到各个后端
+        start = self._rotation
+        self._rotation = (start + 1) % count
+        best = None
+        for i in range(count):
+            backend = self.backends[(start + i) % count]
+            if backend in tried or not self._available(backend, now, False):
+                continue
+            if best is None or (not backend.healthy, backend.outstanding) < (not best.healthy, best.outstanding):
+                best = backend
+        if best is not None and probe:
+            self._available(best, now, True)
+        return best
+
+    def _record_success(self, backend):
+        backend.consecutive_failures = 0
+        if backend.state != CLOSED:
+            logger.info(f"表情包后端已恢复：{backend.url}")
+            backend.state = CLOSED
+
+    def _record_failure(self, backend):
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        if backend.state == HALF_OPEN or (
+            backend.state == CLOSED and backend.consecutive_failures >= self.failure_threshold
+        ):
+            backend.state = OPEN
+            backend.opened_at = time.monotonic()
+            backend.trips += 1
+            logger.warning(f"表情包后端连续失败 {backend.consecutive_failures} 次，已熔断：{backend.url}")
+
+    async def request(self, fn, retries=0):
+        """
+        在选出的后端上执行请求，可切换时依次尝试其他后端
+        :param fn: 协程函数 fn(base_url)，必须是幂等的
+        :param retries: 所有后端都失败后整体重试的次数
+        :return: fn 的返回值
+        """
+        tried = set()
+        attempt = 0
+        while True:
+            backend = self._pick(tried)
+            if backend is None:
+                raise NoBackendAvailableError()
+            tried.add(backend)
+            backend.outstanding += 1
+            backend.requests += 1
+            try:
+                result = await fn(backend.url)
+            except asyncio.CancelledError:
+                # 被取消说明不了后端的好坏；半开状态需要交还试探机会
+                if backend.state == HALF_OPEN:
+                    backend.state = OPEN
+                raise
+            except Exception as e:
+                if not is_failover_error(e):
+                    # 表情包错误等：后端本身是正常的
+                    self._record_success(backend)
+                    raise
+                self._record_failure(backend)
+                if len(tried) < len(self.backends):
+                    self.failovers += 1
+                    logger.debug('后端 %s 请求失败（%r），切换到其他后端', backend.url, e)
+                    continue
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                logger.debug('所有后端请求失败（%r），第%d次重试', e, attempt)
+            else:
+                self._record_success(backend)
+                return result
+            finally:
+                backend.outstanding -= 1
+
+            # 所有后端都失败：退避后重新轮一遍
+            self.retries += 1
+            tried.clear()
+            await asyncio.sleep(_RETRY_BACKOFF * 2 ** (attempt - 1) * (0.5 + random.random()))
+
+    def start(self):
+        """启动后台健康检查"""
+        if self.client is not None and self.health_interval > 0 and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_health()
+
+    async def check_health(self):
+        """并发检查所有后端；检查成功会提前关闭熔断"""
+        await asyncio.gather(*(self._check(backend) for backend in self.backends))
+
+    async def _check(self, backend):
+        try:
+            resp = await self.client.get(f"{backend.url}{HEALTH_PATH}", timeout=_HEALTH_TIMEOUT)
+            healthy = resp.status_code not in FAILOVER_STATUS_CODES
+        except httpx.HTTPError:
+            healthy = False
+        if healthy != backend.healthy:
+            logger.info(f"表情包后端 {backend.url} 健康检查{'恢复' if healthy else '失败'}")
+        backend.healthy = healthy
+        if healthy and backend.state == OPEN:
+            self._record_success(backend)
+
+    def stats(self):
+        """返回后端池统计信息"""
+        return {
+            'backends': len(self.backends),
+            'available': sum(1 for b in self.backends if b.state == CLOSED and b.healthy),
+            'open_circuits': sum(1 for b in self.backends if b.state != CLOSED),
+            'outstanding': sum(b.outstanding for b in self.backends),
+            'requests': sum(b.requests for b in self.backends),
+            'failures': sum(b.failures for b in self.backends),
+            'trips': sum(b.trips for b in self.backends),
+            'failovers': self.failovers,
+            'retries': self.retries,
+        }
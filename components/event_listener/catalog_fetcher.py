@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import random
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+# 这些状态码视为临时错误，可以重试
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+async def fetch_json(client, url, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """
+    GET 请求并解析JSON，遇到网络错误或临时性HTTP错误时按指数退避重试
+    :param retries: 最大重试次数（不含首次请求）
+    :param backoff: 首次重试前的等待秒数，之后每次翻倍并加随机抖动
+    """
+    attempt = 0
+    while True:
+        try:
+            resp = await client.get(url)
+            resp.raise_for_status()
+            return resp.json()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            retryable = isinstance(e, httpx.TransportError) or e.response.status_code in _RETRY_STATUS
+            if not retryable or attempt >= retries:
+                raise
+            delay = backoff * (2 ** attempt) * (1 + random.random() * 0.5)
+            attempt += 1
+            logger.warning(f"请求 {url} 失败（{repr(e)}），{delay:.2f}秒后第{attempt}次重试")
+            await asyncio.sleep(delay)
+
+
+async def fetch_meme_keys(client, base_url, retries=DEFAULT_RETRIES):
+    """获取所有表情包的key"""
+    return await fetch_json(client, f"{base_url}/memes/keys", retries=retries)
+
+
+async def fetch_meme_infos(client, base_url, keys, concurrency=DEFAULT_CONCURRENCY,
+                           retries=DEFAULT_RETRIES, progress=None):
+    """
+    并发获取多个表情包的详细信息
+    :param concurrency: 同时进行的请求数上限
+    :param progress: 可选回调 progress(已完成数, 总数, key, 错误或None)
+    :return: ({key: info}, {key: 错误})
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    infos = {}
+    errors = {}
+    done = 0
+
+    async def fetch_one(key):
+        nonlocal done
+        async with semaphore:
+            try:
+                info = await fetch_json(client, f"{base_url}/memes/{key}/info", retries=retries)
+                # 不保存key字段（key一级格式中key已是顶级键）
+                info.pop('key', None)
+                infos[key] = info
+                error = None
+            except Exception as e:
+                errors[key] = e
+                error = e
+        done += 1
+        if progress is not None:
+            progress(done, len(keys), key, error)
+
+    await asyncio.gather(*(fetch_one(key) for key in keys))
+    return infos, errors
+
+
+async def refresh_catalog(client, base_url, existing=None, incremental=False, revalidate=False,
+                          concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES, progress=None, keys=None):
+    """
+    刷新表情包信息
+    :param existing: 现有的 {key: info}（key一级格式）
+    :param incremental: 增量模式，只获取新增的表情包，删除后端已移除的表情包
+    :param revalidate: 增量模式下同时重新获取已有表情包，按 date_modified 找出有变化的条目
+    :param keys: 已获取的表情包key列表，为None时从后端获取
+    :return: ({key: info}, 统计字典)
+    """
+    existing = existing or {}
+    if keys is None:
+        keys = await fetch_meme_keys(client, base_url, retries=retries)
+
+    if incremental:
+        to_fetch = [key for key in keys if revalidate or key not in existing]
+    else:
+        to_fetch = list(keys)
+
+    fetched, errors = await fetch_meme_infos(
+        client, base_url, to_fetch, concurrency=concurrency, retries=retries, progress=progress
+    )
+
+    memes_info = {}
+    changed = []
+    added = []
+    for key in keys:
+        if key in fetched:
+            info = fetched[key]
+            if key not in existing:
+                added.append(key)
+            elif info.get('date_modified') != existing[key].get('date_modified'):
+                changed.append(key)
+            memes_info[key] = info
+        elif key in existing:
+            # 未重新获取或获取失败时保留原有信息
+            memes_info[key] = existing[key]
+
+    removed = [key for key in existing if key not in memes_info]
+    report = {
+        'total': len(memes_info),
+        'fetched': len(fetched),
+        'added': added,
+        'changed': changed,
+        'removed': removed,
+        'errors': errors,
+    }
+    return memes_info, report
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+
+from .catalog_fetcher import fetch_meme_keys, refresh_catalog
+from .meme_catalog import MEMES_INFO_FILE, SNAPSHOT_FILE, MemeCatalog, MemeSpec, save_yaml, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# 默认刷新间隔（秒），0表示不自动刷新
+DEFAULT_REFRESH_INTERVAL = 600.0
+# 获取信息失败的表情包不算目录变化，按指数退避重试，最长间隔（秒）
+_MAX_RETRY_DELAY = 6 * 3600.0
+
+
+def _build_catalog(memes_info, persist):
+    """在工作线程中构建新目录（解析规格、编译正则、建立索引），可选写回磁盘"""
+    specs = {key: MemeSpec.from_info(key, info) for key, info in memes_info.items()}
+    catalog = MemeCatalog(specs)
+    if persist:
+        try:
+            save_yaml(memes_info, MEMES_INFO_FILE)
+            write_snapshot(specs, SNAPSHOT_FILE, MEMES_INFO_FILE)
+        except (OSError, ValueError) as e:
+            logger.warning(f"保存表情包信息失败：{repr(e)}")
+    return catalog
+
+
+class CatalogRefresher:
+    """后台定期从 /memes/keys 检查表情包目录，有变化时增量获取并原子替换索引"""
+
+    def __init__(self, meme_handler, client, interval=DEFAULT_REFRESH_INTERVAL, persist=True):
+        self.meme_handler = meme_handler
+        self.client = client
+        self.interval = interval
+        self.persist = persist
+        # 目录变化后的回调，签名 callback(catalog)
+        self.listeners = []
+        self._task = None
+        self._lock = asyncio.Lock()
+        # 获取信息失败的表情包：key -> (连续失败次数, 下次重试时间)
+        self._failed = {}
+        self.refresh_count = 0
+        self.change_count = 0
+        self.error_count = 0
+        self.last_refresh_at = None
+        self.last_refresh_duration = None
+
+    def start(self):
+        """启动后台刷新任务"""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """停止后台刷新任务"""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.error_count += 1
+                logger.error(f"刷新表情包目录失败：{repr(e)}")
+
+    async def refresh(self, force=False):
+        """
+        刷新一次表情包目录
+        :param force: 为True时即使key列表未变化也重建目录
+        :return: 目录是否发生变化
+        """
+        async with self._lock:
+            started = time.monotonic()
+            # 从当前可用的后端获取目录（多个后端的目录应一致）
+            base_url = self.meme_handler.backends.primary_url
+            current = self.meme_handler.catalog
+            listed = await fetch_meme_keys(self.client, base_url)
+
+            now = time.monotonic()
+            # 退避中的失败表情包本轮不再获取
+            waiting = {
+                key for key, (_, retry_at) in self._failed.items() if retry_at > now and not force
+            }
+            keys = [key for key in listed if key not in waiting]
+            changed = force
+            if force or set(keys) != set(current.memes_info):
+                existing = await asyncio.to_thread(
+                    lambda: {key: spec.to_info() for key, spec in current.memes_info.items()}
+                )
+                memes_info, report = await refresh_catalog(
+                    self.client, base_url, existing=existing, incremental=True, keys=keys
+                )
+                self._track_failures(listed, report['errors'])
+                # 只有获取失败时目录并没有变化，不重建、不写盘、不通知
+                changed = force or bool(report['added'] or report['removed'] or report['changed'])
+                if changed:
+                    catalog = await asyncio.to_thread(_build_catalog, memes_info, self.persist)
+                    # 引用赋值是原子的，处理中的请求继续使用旧目录
+                    self.meme_handler.swap_catalog(catalog)
+                    self.change_count += 1
+                    logger.info(
+                        f"表情包目录已更新：共 {report['total']} 个，新增 {len(report['added'])} 个，"
+                        f"移除 {len(report['removed'])} 个，失败 {len(report['errors'])} 个"
+                    )
+                    for listener in self.listeners:
+                        try:
+                            listener(catalog)
+                        except Exception as e:
+                            logger.error(f"表情包目录更新回调出错：{repr(e)}")
+                elif report['errors']:
+                    logger.warning(f"获取 {len(report['errors'])} 个表情包信息失败，稍后重试")
+
+            self.refresh_count += 1
+            self.last_refresh_at = time.time()
+            self.last_refresh_duration = time.monotonic() - started
+            return changed
+
+    def _track_failures(self, listed, errors):
+        """
+        记录获取失败的表情包，下次重试时间按连续失败次数指数增长
+        :param listed: 后端当前的全部表情包key
+        """
+        now = time.monotonic()
+        listed = set(listed)
+        # 已成功获取或已从后端移除的表情包不再重试；本轮退避中未获取的保留
+        self._failed = {
+            key: value for key, value in self._failed.items()
+            if key in listed and (key in errors or value[1] > now)
+        }
+        for key in errors:
+            failures = self._failed.get(key, (0, 0.0))[0] + 1
+            delay = min(max(self.interval, 1.0) * 2 ** (failures - 1), _MAX_RETRY_DELAY)
+            self._failed[key] = (failures, now + delay)
+
+    def stats(self):
+        """返回刷新统计信息"""
+        return {
+            'catalog_size': len(self.meme_handler.catalog),
+            'refresh_count': self.refresh_count,
+            'change_count': self.change_count,
+            'error_count': self.error_count,
+            'failed_keys': len(self._failed),
+            'last_refresh_at': self.last_refresh_at,
+            'last_refresh_duration': self.last_refresh_duration,
+        }
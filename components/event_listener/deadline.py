@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+# 单条消息从匹配到回复的默认总时限（秒）
+DEFAULT_MESSAGE_TIMEOUT = 60.0
+# 下载头像最多占用的时间（秒），超时后不再等待头像
+DEFAULT_AVATAR_TIMEOUT = 5.0
+
+
+class MemeTimeoutError(RuntimeError):
+    """消息处理超过时限"""
+
+    def __init__(self, stage):
+        super().__init__("生成表情包超时，请稍后再试")
+        self.stage = stage
+
+
+class Deadline:
+    """单条消息的处理时限，各阶段从剩余时间中分配预算"""
+
+    __slots__ = ('expires_at',)
+
+    def __init__(self, timeout):
+        """:param timeout: 总时限（秒），0或负数表示不限时"""
+        self.expires_at = time.monotonic() + timeout if timeout and timeout > 0 else None
+
+    def remaining(self, cap=None):
+        """
+        剩余时间
+        :param cap: 当前阶段的预算上限
+        :return: 秒数；不限时且没有上限时返回None
+        """
+        if self.expires_at is None:
+            return cap
+        left = max(0.0, self.expires_at - time.monotonic())
+        return left if cap is None else min(left, cap)
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    async def run(self, stage, awaitable, cap=None):
+        """
+        在预算内等待 awaitable，超时时取消并抛出 MemeTimeoutError
+        :param stage: 阶段名称，写入异常便于统计
+        """
+        timeout = self.remaining(cap)
+        if timeout is not None and timeout <= 0:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise MemeTimeoutError(stage)
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            raise MemeTimeoutError(stage) from None
@@ -1,35 +1,228 @@
 from __future__ import annotations
 
-import base64
-import httpx
+import asyncio
 import logging
+import time
 from langbot_plugin.api.definition.components.common.event_listener import EventListener
 from langbot_plugin.api.entities import events, context
 from langbot_plugin.api.entities.builtin.platform import message as platform_message
 
-from .meme_request_handler import MemeRequestHandler
+from .avatar_cache import AvatarCache, DEFAULT_MAX_BYTES, DEFAULT_NEGATIVE_TTL, DEFAULT_TTL
+from .backend_pool import (
+    DEFAULT_FAILURE_THRESHOLD,
+    DEFAULT_HEALTH_INTERVAL,
+    DEFAULT_RESET_TIMEOUT,
+    BackendPool,
+    parse_backend_urls,
+)
+from .catalog_refresher import DEFAULT_REFRESH_INTERVAL, CatalogRefresher
+from .deadline import DEFAULT_AVATAR_TIMEOUT, DEFAULT_MESSAGE_TIMEOUT, Deadline, MemeTimeoutError
+from .http_client import create_http_client
+from .image_codec import DEFAULT_OFFLOAD_THRESHOLD, DEFAULT_WORKERS, ImageCodec
+from .image_preprocess import DEFAULT_MAX_SIDE, DEFAULT_TRANSCODE_THRESHOLD, ImagePreprocessor
+from .meme_request_handler import (
+    DEFAULT_HEDGE_MIN_DELAY,
+    DEFAULT_MAX_RESPONSE_BYTES,
+    DEFAULT_RENDER_RETRIES,
+    MemeRequestHandler,
+)
+from .metrics import DEFAULT_METRICS_HOST, Metrics, MetricsExporter
+from .prewarm import (
+    DEFAULT_INTERVAL as DEFAULT_PREWARM_INTERVAL,
+    DEFAULT_MAX_BYTES as DEFAULT_PREWARM_MAX_BYTES,
+    DEFAULT_POPULARITY_FILE,
+    DEFAULT_TOP_N as DEFAULT_PREWARM_TOP_N,
+    PopularityTracker,
+    Prewarmer,
+)
+from .result_cache import (
+    DEFAULT_DISK_DIR,
+    DEFAULT_DISK_MAX_BYTES,
+    DEFAULT_MEMORY_MAX_BYTES,
+    MemeResultCache,
+    make_cache_key,
+)
+from .scheduler import (
+    DEFAULT_MAX_CONCURRENCY as DEFAULT_RENDER_CONCURRENCY,
+    DEFAULT_MAX_QUEUE as DEFAULT_RENDER_QUEUE,
+    DEFAULT_MAX_QUEUE_PER_GROUP as DEFAULT_RENDER_QUEUE_PER_GROUP,
+    RenderScheduler,
+)
+from .settings import get_number
 
 # 创建logger实例
 logger = logging.getLogger(__name__)
 
+# 默认的表情包搜索指令，如 “表情搜索 摸头”
+DEFAULT_SEARCH_COMMAND = '表情搜索'
+_SEARCH_LIMIT = 8
+# 一条多表情包指令最多包含的表情包数，以及同时生成的数量
+DEFAULT_FANOUT_MAX_MEMES = 5
+DEFAULT_FANOUT_CONCURRENCY = 3
+
 
 class DefaultEventListener(EventListener):
+    # 自定义httpx transport，压测或调试时可替换为本地模拟后端
+    http_transport = None
+
     def __init__(self):
         super().__init__()
         # 从配置中获取memeurl
         self.memeurl = None
+        # 插件共享的HTTP客户端，在initialize中创建
+        self.http_client = None
+        # 表情包目录后台刷新任务
+        self.catalog_refresher = None
+        # 热门无图片表情包的后台预生成
+        self.prewarmer = None
+        # 图片编解码线程池
+        self.image_codec = None
+        # 表情包后端池（负载路由、熔断、健康检查）
+        self.backend_pool = None
+        # 生成请求调度（全局并发上限、按群公平排队、队列满时拒绝）
+        self.scheduler = None
+        # 单条消息的处理时限和其中头像下载的预算（秒）
+        self.message_timeout = DEFAULT_MESSAGE_TIMEOUT
+        self.avatar_timeout = DEFAULT_AVATAR_TIMEOUT
+        # 表情包搜索指令，为空时关闭
+        self.search_command = DEFAULT_SEARCH_COMMAND
+        # 多表情包指令（如 “摸+举牌”）的表情包数上限（1表示关闭）和生成并发数
+        self.fanout_max_memes = DEFAULT_FANOUT_MAX_MEMES
+        self.fanout_concurrency = DEFAULT_FANOUT_CONCURRENCY
+        # 各处理阶段的延迟直方图和计数器
+        self.metrics = Metrics()
+        # 指标导出（抓取端口/定期写文件），在initialize中按配置创建
+        self.metrics_exporter = None
         # 初始化表情包请求处理器，但暂时不传入memeurl参数
         # 将在initialize方法中重新设置meme_handler
         
     async def initialize(self):
         await super().initialize()
 
-        self.memeurl = self.plugin.get_config().get("memeurl", None)
+        config = self.plugin.get_config()
+        self.memeurl = config.get("memeurl", None)
+        self.message_timeout = get_number(config, 'message_timeout', DEFAULT_MESSAGE_TIMEOUT)
+        self.avatar_timeout = get_number(config, 'avatar_timeout', DEFAULT_AVATAR_TIMEOUT)
+        self.search_command = str(config.get('meme_search_command', DEFAULT_SEARCH_COMMAND) or '').strip()
+        self.fanout_max_memes = get_number(config, 'fanout_max_memes', DEFAULT_FANOUT_MAX_MEMES, int)
+        self.fanout_concurrency = max(1, get_number(config, 'fanout_concurrency', DEFAULT_FANOUT_CONCURRENCY, int))
+        # 创建长连接客户端，表情包后端和头像下载共用同一个连接池
+        self.http_client = create_http_client(config, transport=self.http_transport)
+        # 图片base64编解码，超过阈值时交给线程池
+        self.image_codec = ImageCodec(
+            offload_threshold=get_number(config, 'codec_offload_threshold_kb', DEFAULT_OFFLOAD_THRESHOLD / 1024) * 1024,
+            workers=get_number(config, 'codec_workers', DEFAULT_WORKERS, int),
+        )
+        # 上传前的图片缩放、转码（需要Pillow）
+        preprocessor = None
+        if config.get('image_preprocess', True):
+            if ImagePreprocessor.available():
+                preprocessor = ImagePreprocessor(
+                    max_side=get_number(config, 'image_max_side', DEFAULT_MAX_SIDE, int),
+                    size_overrides=config.get('image_size_overrides') or [],
+                    static_memes=config.get('image_static_memes') or [],
+                    transcode_threshold=get_number(
+                        config, 'image_transcode_threshold_kb', DEFAULT_TRANSCODE_THRESHOLD / 1024
+                    ) * 1024,
+                    codec=self.image_codec,
+                )
+            else:
+                logger.warning("未安装 Pillow，已跳过图片预处理")
+        # memeurl 可以填写多个后端（逗号分隔），请求按负载分配并在故障时切换
+        self.backend_pool = BackendPool(
+            parse_backend_urls(self.memeurl),
+            self.http_client,
+            failure_threshold=get_number(config, 'backend_failure_threshold', DEFAULT_FAILURE_THRESHOLD, int),
+            reset_timeout=get_number(config, 'backend_reset_timeout', DEFAULT_RESET_TIMEOUT),
+            health_interval=get_number(config, 'backend_health_interval', DEFAULT_HEALTH_INTERVAL),
+        )
+        self.backend_pool.start()
+        # 所有后端生成请求都经过调度：刷屏的群只会占满自己的队列，不会拖慢其他群
+        self.scheduler = RenderScheduler(
+            max_concurrency=get_number(config, 'render_concurrency', DEFAULT_RENDER_CONCURRENCY, int),
+            max_queue=get_number(config, 'render_queue_size', DEFAULT_RENDER_QUEUE, int),
+            max_queue_per_group=get_number(
+                config, 'render_queue_per_group', DEFAULT_RENDER_QUEUE_PER_GROUP, int
+            ),
+            weights=config.get('render_group_weights') or [],
+            metrics=self.metrics,
+        )
         # 初始化表情包请求处理器，传入memeurl参数
-        self.meme_handler = MemeRequestHandler(self.memeurl)
+        self.meme_handler = MemeRequestHandler(
+            self.memeurl,
+            client=self.http_client,
+            max_response_bytes=int(get_number(
+                config, 'max_response_mb', DEFAULT_MAX_RESPONSE_BYTES / 1024 / 1024
+            ) * 1024 * 1024),
+            preprocessor=preprocessor,
+            metrics=self.metrics,
+            backends=self.backend_pool,
+            retries=get_number(config, 'render_retries', DEFAULT_RENDER_RETRIES, int),
+            # 配置中按百分位填写（如95），0表示不发对冲请求
+            hedge_percentile=get_number(config, 'hedge_percentile', 0) / 100,
+            hedge_min_delay=get_number(config, 'hedge_min_delay', DEFAULT_HEDGE_MIN_DELAY),
+            fuzzy_dispatch=bool(config.get('fuzzy_match', False)),
+        )
+        # 头像缓存：按QQ号缓存，限制总字节数并设置TTL
+        self.avatar_cache = AvatarCache(
+            self.http_client,
+            max_bytes=get_number(config, 'avatar_cache_max_mb', DEFAULT_MAX_BYTES / 1024 / 1024) * 1024 * 1024,
+            ttl=get_number(config, 'avatar_cache_ttl', DEFAULT_TTL),
+            negative_ttl=get_number(config, 'avatar_cache_negative_ttl', DEFAULT_NEGATIVE_TTL),
+        )
+        # 生成结果缓存：内存LRU + 可选的磁盘缓存（data/meme_cache）
+        self.result_cache = MemeResultCache(
+            memory_max_bytes=get_number(
+                config, 'result_cache_memory_mb', DEFAULT_MEMORY_MAX_BYTES / 1024 / 1024
+            ) * 1024 * 1024,
+            disk_dir=DEFAULT_DISK_DIR if config.get('result_cache_disk', False) else None,
+            disk_max_bytes=get_number(
+                config, 'result_cache_disk_mb', DEFAULT_DISK_MAX_BYTES / 1024 / 1024
+            ) * 1024 * 1024,
+        )
+        # 后台定期刷新表情包目录，新增的表情包无需重启插件即可使用
+        self.catalog_refresher = CatalogRefresher(
+            self.meme_handler,
+            self.http_client,
+            interval=get_number(config, 'catalog_refresh_interval', DEFAULT_REFRESH_INTERVAL),
+        )
+        self.catalog_refresher.start()
+        # 按热度预生成无图片表情包，目录变化后重新生成
+        self.prewarmer = Prewarmer(
+            self.meme_handler,
+            PopularityTracker(path=DEFAULT_POPULARITY_FILE),
+            top_n=get_number(config, 'prewarm_top_n', DEFAULT_PREWARM_TOP_N, int),
+            max_bytes=get_number(
+                config, 'prewarm_memory_mb', DEFAULT_PREWARM_MAX_BYTES / 1024 / 1024
+            ) * 1024 * 1024,
+            interval=get_number(config, 'prewarm_interval', DEFAULT_PREWARM_INTERVAL),
+            scheduler=self.scheduler,
+        )
+        self.catalog_refresher.listeners.append(self.prewarmer.on_catalog_change)
+        self.prewarmer.start()
+
+        # 各组件的统计信息在抓取/导出指标时一并读取
+        self.metrics.register('dispatch', self.meme_handler.stats)
+        self.metrics.register('avatar_cache', self.avatar_cache.stats)
+        self.metrics.register('result_cache', self.result_cache.stats)
+        self.metrics.register('catalog', self.catalog_refresher.stats)
+        self.metrics.register('prewarm', self.prewarmer.stats)
+        self.metrics.register('scheduler', self.scheduler.stats)
+        if preprocessor is not None:
+            self.metrics.register('preprocess', preprocessor.stats)
+        self.metrics_exporter = MetricsExporter(
+            self.metrics,
+            port=get_number(config, 'metrics_port', 0, int),
+            host=config.get('metrics_host') or DEFAULT_METRICS_HOST,
+            dump_interval=get_number(config, 'metrics_dump_interval', 0),
+        )
+        await self.metrics_exporter.start()
         
+        metrics = self.metrics
+
         @self.handler(events.GroupMessageReceived)
         async def handler(event_context: context.EventContext):
+            started = time.perf_counter()
             # 获取用户消息文本，并确保排除AT标记
             message_parts = []
             for element in event_context.event.message_chain:
@@ -39,221 +232,446 @@ class DefaultEventListener(EventListener):
             
             # 合并所有普通文本部分
             message_text = ''.join(message_parts)
-            # logger.info(f'原始消息链={event_context.event.message_chain}')
-            logger.info(f'event={event_context.event}')
-            # 移除prevent_default()，允许其他处理器也能处理消息
             # 如果用户输入包含[Image]标记，剔除它
             if '[Image]' in message_text:
                 message_text = message_text.replace('[Image]', '').strip()
-            
-            # 解析用户消息，格式：表情包关键词 文本内容
-            parts = message_text.strip().split(" ", 1)
-            if len(parts) < 1:
-                await event_context.reply(
-                    platform_message.MessageChain([
-                        platform_message.Plain(text="请输入表情包关键词和文本内容，格式：表情包关键词 文本内容\n")
-                    ])
-                )
+
+            # 表情包搜索指令：回复相近的关键词
+            search_command = self.search_command
+            if search_command and message_text.startswith(search_command):
+                query = message_text[len(search_command):].strip()
+                if query:
+                    await self._reply_suggestions(event_context, query)
+                    return
+
+            # 通过分发索引一次查表匹配关键词、表情包key和快捷指令
+            # 不是表情包指令的消息直接忽略，不做任何解析、头像下载或后端请求
+            parsed = time.perf_counter()
+            fanout = self.fanout_max_memes > 1
+            # 开启多表情包指令时，两种匹配都失败才计为未匹配
+            match = self.meme_handler.dispatch(message_text, count_rejected=not fanout)
+            matches = None
+            if match is None and fanout:
+                # 多表情包指令，如 “摸+举牌 文本”：输入只获取一次，并发生成
+                matches = self.meme_handler.dispatch_many(message_text, self.fanout_max_memes)
+            metrics.observe('parse', parsed - started)
+            metrics.observe('match', time.perf_counter() - parsed)
+            if match is None and matches is None:
                 return
-            
-            # 首先尝试匹配 keywords
-            first_word = parts[0]
-            meme_key = self.meme_handler.match_keyword(first_word)
-            
-            # 如果没有匹配到 keywords，回退使用第一个词作为 meme_key
-            if meme_key is None:
-                meme_key = first_word
-            
-            # 初始化texts列表
-            texts = []
-            
-            # 检查meme_key是否存在于memes_info中，以及其是否需要多个文本
-            if meme_key in self.meme_handler.memes_info:
-                meme_info = self.meme_handler.memes_info[meme_key]
-                # 如果有文本内容
-                if len(parts) > 1:
-                    # 默认以逗号分隔多个文本
-                    texts = [t.strip() for t in parts[1].split(',')]
-                    
-                    # 检查文本数量是否符合要求
-                    min_texts = meme_info.get('params_type', {}).get('min_texts', 0)
-                    max_texts = meme_info.get('params_type', {}).get('max_texts', 0)
-                    
-                    # 如果文本数量不足，使用默认文本填充
-                    if len(texts) < min_texts and 'default_texts' in meme_info.get('params_type', {}):
-                        default_texts = meme_info['params_type']['default_texts']
-                        # 只填充需要的数量
-                        texts += default_texts[len(texts):min_texts]
-                    
-                    # 如果文本数量超过最大限制，截断
-                    if max_texts > 0 and len(texts) > max_texts:
-                        texts = texts[:max_texts]
-                else:
-                    # 没有提供文本，检查是否有默认文本
-                    if 'default_texts' in meme_info.get('params_type', {}):
-                        texts = meme_info['params_type']['default_texts']
-            else:
-                # 如果meme_key不在memes_info中，使用原来的处理方式
-                if len(parts) > 1:
-                    texts = [parts[1]]
+
+            logger.debug('event=%s', event_context.event)
+            try:
+                if matches is not None:
+                    for item in matches:
+                        metrics.inc('requests', 'meme_key', item.meme_key)
+                        self.prewarmer.record(item.meme_key)
+                    metrics.inc('fanout', 'memes', len(matches))
+                    await self._handle_fanout(event_context, matches, message_text)
                 else:
-                    texts = []
+                    metrics.inc('requests', 'meme_key', match.meme_key)
+                    self.prewarmer.record(match.meme_key)
+                    await self._handle_meme(event_context, match, message_text)
+            finally:
+                metrics.observe('total', time.perf_counter() - started)
+
+    def _build_texts(self, match):
+        """
+        组装表情包的文本和参数
+        :param match: 分发索引返回的 DispatchMatch
+        :return: (文本列表, args字典)
+        """
+        spec = match.spec
+
+        # 快捷指令参数：位置参数作为文本，选项映射为后端args
+        shortcut_texts, meme_args = self.meme_handler.parse_shortcut_args(spec, match.shortcut_args)
+
+        # 初始化texts列表
+        texts = []
+        
+        # 如果有文本内容
+        if shortcut_texts or match.text:
+            # 默认以逗号分隔多个文本
+            texts = shortcut_texts + ([t.strip() for t in match.text.split(',')] if match.text else [])
             
-            # 先获取表情包信息以确定是否需要图片
-            max_images = 0
-            min_images = 0
-            if meme_key in self.meme_handler.memes_info:
-                meme_info = self.meme_handler.memes_info[meme_key]
-                min_images = meme_info.get('params_type', {}).get('min_images', 0)
-                max_images = meme_info.get('params_type', {}).get('max_images', 0)
+            # 检查文本数量是否符合要求
+            min_texts = spec.min_texts
+            max_texts = spec.max_texts
             
-            # 初始化最终的images列表
-            images = []
+            # 如果文本数量不足，使用默认文本填充（只填充需要的数量）
+            if len(texts) < min_texts and spec.default_texts:
+                texts += spec.default_texts[len(texts):min_texts]
+            
+            # 如果文本数量超过最大限制，截断
+            if max_texts > 0 and len(texts) > max_texts:
+                texts = texts[:max_texts]
+        else:
+            # 没有提供文本，使用默认文本
+            texts = list(spec.default_texts)
+        return texts, meme_args
+
+    @staticmethod
+    def _fit_texts(spec, texts):
+        """
+        把多表情包指令共用的文本调整为该表情包可接受的数量：
+        不接受文本的表情包不发送文本，多余的截断，不足的用默认文本补齐
+        """
+        if spec.max_texts == 0:
+            return []
+        texts = texts[:spec.max_texts]
+        if len(texts) < spec.min_texts:
+            texts += spec.default_texts[len(texts):spec.min_texts]
+        return texts
+
+    async def _collect_images(self, event_context, max_images, deadline):
+        """
+        从消息中提取用户图片，并按需下载发送者和AT目标的头像（多个表情包共用一次下载）
+        :param max_images: 所需的最多图片数，用户图片足够时不下载头像
+        :return: (用户图片列表, sender头像, 被at用户头像, 头像下载是否超时)
+        """
+        metrics = self.metrics
+        # 初始化并从消息链中提取图片和AT信息
+        user_images = []  # 用户主动传入的图片
+        at_target_id = None
+
+        # 检查消息链中是否有AT标记和用户传入的图片
+        for element in event_context.event.message_chain:
+            if hasattr(element, 'type'):
+                if element.type == 'At' and hasattr(element, 'target'):
+                    # 记录AT的目标ID
+                    at_target_id = element.target
+                elif element.type == 'Image' and hasattr(element, 'base64') and element.base64:
+                    # 解码图片的base64数据（去掉data URL前缀时不复制，大图在线程池中解码）
+                    with metrics.span('decode'):
+                        img_bytes = await self.image_codec.decode(element.base64)
+                    user_images.append(img_bytes)
 
-            # 只有当表情包需要图片时才处理图片相关逻辑
-            if max_images > 0:
-                # 初始化并从消息链中提取图片和AT信息
-                user_images = []  # 用户主动传入的图片
+        # 首先，获取可能需要的头像（AT目标头像和发送者头像）
+        at_avatar = None
+        sender_avatar = None
+        sender_id = None
+        avatar_timed_out = False
+
+        # 用户传入的图片已足够时无需下载头像
+        if len(user_images) < max_images:
+            # 并发获取发送者和AT目标的头像（走头像缓存，AT目标与发送者相同时不重复获取）
+            if hasattr(event_context.event, 'sender_id'):
+                sender_id = event_context.event.sender_id
+            if at_target_id == sender_id:
                 at_target_id = None
+            with metrics.span('avatar'):
+                try:
+                    sender_avatar, at_avatar = await deadline.run(
+                        'avatar', self.avatar_cache.get_many(sender_id, at_target_id), cap=self.avatar_timeout
+                    )
+                except MemeTimeoutError:
+                    # 头像下载超时：不再等待，图片不足时直接回复超时
+                    metrics.inc('timeouts', 'stage', 'avatar')
+                    avatar_timed_out = True
+        return user_images, sender_avatar, at_avatar, avatar_timed_out
 
-                # 检查消息链中是否有AT标记和用户传入的图片
-                for element in event_context.event.message_chain:
-                    if hasattr(element, 'type'):
-                        if element.type == 'At' and hasattr(element, 'target'):
-                            # 记录AT的目标ID
-                            at_target_id = element.target
-                        elif element.type == 'Image' and hasattr(element, 'base64') and element.base64:
-                            # 提取图片的base64数据
-                            base64_data = element.base64
-                            if ',' in base64_data:
-                                base64_data = base64_data.split(',')[1]
-                            img_bytes = base64.b64decode(base64_data)
-                            user_images.append(img_bytes)
-
-                # 新的优先级规则：
-                # 1. 最高优先级：用户主动传入的图片（按顺序）
-                # 2. 其次：被at用户的头像
-                # 3. 最后：sender的头像
-                # 特殊规则（需要2张图片时）：
-                #   - 用户传了2张：使用用户的两张图
-                #   - 用户传了1张：图1=sender头像，图2=用户图片
-                #   - 没传图有at：图1=sender头像，图2=被at用户头像
-                #   - 没传图没at：图1=sender头像，图2=sender头像
-
-                # 首先，获取可能需要的头像（AT目标头像和发送者头像）
-                at_avatar = None
-                sender_avatar = None
-                sender_id = None
-
-                # 1. 获取发送者头像
-                if hasattr(event_context.event, 'sender_id'):
-                    sender_id = event_context.event.sender_id
-                    try:
-                        async with httpx.AsyncClient() as client:
-                            img_url = f"http://q1.qlogo.cn/g?b=qq&nk={sender_id}&s=100"
-                            img_resp = await client.get(img_url)
-                            img_resp.raise_for_status()
-                            sender_avatar = img_resp.content
-                    except Exception as e:
-                        logger.error(f"获取发送者QQ头像时出错：{repr(e)}")
-
-                # 2. 获取AT目标头像（如果有且与发送者不同）
-                if at_target_id and at_target_id != sender_id:
-                    try:
-                        async with httpx.AsyncClient() as client:
-                            img_url = f"http://q1.qlogo.cn/g?b=qq&nk={at_target_id}&s=100"
-                            img_resp = await client.get(img_url)
-                            img_resp.raise_for_status()
-                            at_avatar = img_resp.content
-                    except Exception as e:
-                        logger.error(f"获取AT目标QQ头像时出错：{repr(e)}")
-
-                # 根据所需图片数量应用不同的优先级规则
-                if max_images == 1:
-                    # 需要1张图片时的优先级：用户图片 > 被at用户头像 > sender头像
-                    if user_images:
-                        images = [user_images[0]]
-                    elif at_avatar:
-                        images = [at_avatar]
-                    elif sender_avatar:
-                        images = [sender_avatar]
-                elif max_images == 2:
-                    # 需要2张图片时的特殊规则
-                    if len(user_images) >= 2:
-                        # 用户传了2张图：使用用户的两张图
-                        images = [user_images[0], user_images[1]]
-                    elif len(user_images) == 1:
-                        # 用户传了1张图：图1=sender头像，图2=用户图片
-                        if sender_avatar:
-                            images = [sender_avatar, user_images[0]]
-                        else:
-                            images = [user_images[0]]
-                    elif at_avatar:
-                        # 没传图有at：图1=sender头像，图2=被at用户头像
-                        if sender_avatar:
-                            images = [sender_avatar, at_avatar]
-                        else:
-                            images = [at_avatar]
-                    elif sender_avatar:
-                        # 没传图没at：图1=sender头像，图2=sender头像
-                        images = [sender_avatar, sender_avatar]
+    @staticmethod
+    def _select_images(max_images, user_images, sender_avatar, at_avatar):
+        """
+        按优先级为表情包选择图片
+        新的优先级规则：
+        1. 最高优先级：用户主动传入的图片（按顺序）
+        2. 其次：被at用户的头像
+        3. 最后：sender的头像
+        特殊规则（需要2张图片时）：
+          - 用户传了2张：使用用户的两张图
+          - 用户传了1张：图1=sender头像，图2=用户图片
+          - 没传图有at：图1=sender头像，图2=被at用户头像
+          - 没传图没at：图1=sender头像，图2=sender头像
+        """
+        images = []
+        # 根据所需图片数量应用不同的优先级规则
+        if max_images == 1:
+            # 需要1张图片时的优先级：用户图片 > 被at用户头像 > sender头像
+            if user_images:
+                images = [user_images[0]]
+            elif at_avatar:
+                images = [at_avatar]
+            elif sender_avatar:
+                images = [sender_avatar]
+        elif max_images == 2:
+            # 需要2张图片时的特殊规则
+            if len(user_images) >= 2:
+                # 用户传了2张图：使用用户的两张图
+                images = [user_images[0], user_images[1]]
+            elif len(user_images) == 1:
+                # 用户传了1张图：图1=sender头像，图2=用户图片
+                if sender_avatar:
+                    images = [sender_avatar, user_images[0]]
+                else:
+                    images = [user_images[0]]
+            elif at_avatar:
+                # 没传图有at：图1=sender头像，图2=被at用户头像
+                if sender_avatar:
+                    images = [sender_avatar, at_avatar]
                 else:
-                    # 其他情况（max_images > 2）
-                    # 优先级：用户图片 > 被at用户头像 > sender头像
-                    # 先添加所有用户传入的图片
-                    images.extend(user_images)
-                    # 如果还需要更多图片，添加被at用户头像
-                    if at_avatar and len(images) < max_images:
-                        images.append(at_avatar)
-                    # 如果还需要更多图片，添加sender头像
-                    if sender_avatar and len(images) < max_images:
-                        images.append(sender_avatar)
-
-                # 确保图片数量不超过所需数量
-                images = images[:max_images]
-
-            logger.info(f'用户输入：{message_text}')
-            logger.info(f'解析后的关键词：{meme_key}')
-            logger.info(f'解析后的文本内容：{texts}')
-            logger.info(f'提取到的图片数量：{len(images)}')
+                    images = [at_avatar]
+            elif sender_avatar:
+                # 没传图没at：图1=sender头像，图2=sender头像
+                images = [sender_avatar, sender_avatar]
+        else:
+            # 其他情况（max_images > 2）
+            # 优先级：用户图片 > 被at用户头像 > sender头像
+            # 先添加所有用户传入的图片
+            images.extend(user_images)
+            # 如果还需要更多图片，添加被at用户头像
+            if at_avatar and len(images) < max_images:
+                images.append(at_avatar)
+            # 如果还需要更多图片，添加sender头像
+            if sender_avatar and len(images) < max_images:
+                images.append(sender_avatar)
 
-            try:
-                # 调用表情包请求处理器生成图片
-                img_bytes = await self.meme_handler.generate_meme(meme_key, texts, images)
-                
-                # 将生成的图片转换为base64格式
-                img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-                
-                # 发送生成的表情包
-                await event_context.reply(
-                    platform_message.MessageChain([
-                        platform_message.Image(base64=img_base64)
-                    ])
+        # 确保图片数量不超过所需数量
+        return images[:max_images]
+
+    @staticmethod
+    def _requester(event_context):
+        """
+        :return: (群号, 发送者)，用于生成请求的公平调度
+        """
+        event = event_context.event
+        return getattr(event, 'launcher_id', None), getattr(event, 'sender_id', None)
+
+    async def _render(self, meme_key, texts, meme_args, images, deadline, requester):
+        """
+        生成表情包（先查结果缓存）
+        :param requester: (群号, 发送者)，需要请求后端时按此排队
+        :return: 图片二进制数据，后端生成失败时返回None
+        """
+        with self.metrics.span('render'):
+            # 先查预生成结果和结果缓存，命中时不再请求后端
+            cache_key = make_cache_key(meme_key, texts, meme_args, images)
+            img_bytes = self.prewarmer.get(cache_key) if self.prewarmer is not None else None
+            if img_bytes is None:
+                img_bytes = await self.result_cache.get(cache_key)
+            if img_bytes is None:
+                # 调用表情包请求处理器生成图片，排队和生成最多等到消息时限用完
+                generate = lambda: self.meme_handler.generate_meme(
+                    meme_key, texts, images, meme_args, request_key=cache_key
                 )
-                event_context.prevent_default()
-            except ValueError as e:
-                # 处理未找到表情包的情况
+                if cache_key in self.meme_handler.singleflight:
+                    # 相同的请求正在生成：直接等待结果，不再占用排队名额
+                    img_bytes = await deadline.run('render', generate())
+                else:
+                    img_bytes = await deadline.run('render', self.scheduler.run(*requester, generate))
+                await self.result_cache.put(cache_key, img_bytes)
+        if img_bytes is None:
+            # 后端生成失败（具体原因已按类型计入 render_errors）
+            self.metrics.inc('errors', 'type', 'render_failed')
+        return img_bytes
+
+    async def _handle_meme(self, event_context, match, message_text):
+        """
+        处理一条已匹配的表情包指令：组装文本和图片、生成并回复
+        :param match: 分发索引返回的 DispatchMatch
+        """
+        # 移除prevent_default()，允许其他处理器也能处理消息
+        metrics = self.metrics
+        started = time.perf_counter()
+        # 从匹配开始计时，头像下载和后端渲染共用这一预算
+        deadline = Deadline(self.message_timeout)
+
+        # 解析用户消息，格式：表情包关键词 文本内容
+        meme_key = match.meme_key
+        spec = match.spec
+        texts, meme_args = self._build_texts(match)
+        metrics.observe('args', time.perf_counter() - started)
+        
+        # 先获取表情包信息以确定是否需要图片
+        min_images = spec.min_images
+        max_images = spec.max_images
+        
+        # 初始化最终的images列表
+        images = []
+
+        # 只有当表情包需要图片时才处理图片相关逻辑
+        if max_images > 0:
+            user_images, sender_avatar, at_avatar, avatar_timed_out = await self._collect_images(
+                event_context, max_images, deadline
+            )
+            images = self._select_images(max_images, user_images, sender_avatar, at_avatar)
+
+            if avatar_timed_out and len(images) < min_images:
                 await event_context.reply(
                     platform_message.MessageChain([
-                        platform_message.Plain(text=str(e))
+                        platform_message.Plain(text=str(MemeTimeoutError('avatar')))
                     ])
                 )
-            except RuntimeError as e:
-                # 处理其他运行时错误
+                return
+
+        # 日志参数延迟格式化，未开启DEBUG时几乎没有开销
+        logger.debug(
+            '用户输入：%s，关键词：%s，文本内容：%s，图片数量：%d',
+            message_text, meme_key, texts, len(images),
+        )
+
+        try:
+            img_bytes = await self._render(
+                meme_key, texts, meme_args, images, deadline, self._requester(event_context)
+            )
+            if img_bytes is None:
+                return
+            
+            # 将生成的图片转换为base64格式（大图在线程池中编码，不阻塞其他群的消息）
+            with metrics.span('encode'):
+                img_base64 = await self.image_codec.encode(img_bytes)
+            
+            # 发送生成的表情包
+            with metrics.span('reply'):
                 await event_context.reply(
                     platform_message.MessageChain([
-                        platform_message.Plain(text=str(e))
+                        platform_message.Image(base64=img_base64)
                     ])
                 )
+            event_context.prevent_default()
+        except MemeTimeoutError as e:
+            # 超时：告知用户，而不是一直没有回应
+            metrics.inc('timeouts', 'stage', e.stage)
+            await event_context.reply(
+                platform_message.MessageChain([
+                    platform_message.Plain(text=str(e))
+                ])
+            )
+        except ValueError as e:
+            metrics.inc('errors', 'type', type(e).__name__)
+            # 处理未找到表情包的情况
+            await event_context.reply(
+                platform_message.MessageChain([
+                    platform_message.Plain(text=str(e))
+                ])
+            )
+        except RuntimeError as e:
+            metrics.inc('errors', 'type', type(e).__name__)
+            # 处理其他运行时错误
+            await event_context.reply(
+                platform_message.MessageChain([
+                    platform_message.Plain(text=str(e))
+                ])
+            )
+        except Exception as e:
+            # 处理未知错误
+            metrics.inc('errors', 'type', type(e).__name__)
+            logger.debug('处理表情包消息出错：%r', e)
+            # await event_context.reply(
+            #     platform_message.MessageChain([
+            #         platform_message.Plain(text=f"生成表情包时出错：{str(e)}")
+            #     ])
+            # )
+            return
+
+    async def _handle_fanout(self, event_context, matches, message_text):
+        """
+        处理多表情包指令：头像等输入只获取一次，各表情包并发生成（受并发上限约束），
+        合并为一条消息回复，生成失败的表情包在消息中以文字说明
+        :param matches: 各表情包的 DispatchMatch（共用同一段文本）
+        """
+        metrics = self.metrics
+        deadline = Deadline(self.message_timeout)
+
+        # 所有表情包共用一份用户图片和头像，按需要图片最多的表情包准备
+        max_images = max(match.spec.max_images for match in matches)
+        user_images, sender_avatar, at_avatar, avatar_timed_out = [], None, None, False
+        if max_images > 0:
+            user_images, sender_avatar, at_avatar, avatar_timed_out = await self._collect_images(
+                event_context, max_images, deadline
+            )
+        logger.debug('用户输入：%s，关键词：%s', message_text, [match.meme_key for match in matches])
+
+        semaphore = asyncio.Semaphore(self.fanout_concurrency)
+        requester = self._requester(event_context)
+
+        async def render_one(match):
+            """:return: 图片元素，失败时返回说明文字"""
+            spec = match.spec
+            try:
+                texts, meme_args = self._build_texts(match)
+                texts = self._fit_texts(spec, texts)
+                images = []
+                if spec.max_images > 0:
+                    images = self._select_images(spec.max_images, user_images, sender_avatar, at_avatar)
+                    if avatar_timed_out and len(images) < spec.min_images:
+                        raise MemeTimeoutError('avatar')
+                async with semaphore:
+                    img_bytes = await self._render(
+                        match.meme_key, texts, meme_args, images, deadline, requester
+                    )
+                if img_bytes is None:
+                    return "生成失败"
+                with metrics.span('encode'):
+                    return platform_message.Image(base64=await self.image_codec.encode(img_bytes))
+            except MemeTimeoutError as e:
+                metrics.inc('timeouts', 'stage', e.stage)
+                return str(e)
+            except (ValueError, RuntimeError) as e:
+                metrics.inc('errors', 'type', type(e).__name__)
+                return str(e)
             except Exception as e:
-                # 处理未知错误
-                # await event_context.reply(
-                #     platform_message.MessageChain([
-                #         platform_message.Plain(text=f"生成表情包时出错：{str(e)}")
-                #     ])
-                # )
-                return
-                
+                metrics.inc('errors', 'type', type(e).__name__)
+                logger.debug('生成表情包出错（%s）：%r', match.meme_key, e)
+                return "生成失败"
+
+        results = await asyncio.gather(*(render_one(match) for match in matches))
+
+        chain = []
+        for match, result in zip(matches, results):
+            if isinstance(result, str):
+                metrics.inc('fanout_failures', 'meme_key', match.meme_key)
+                chain.append(platform_message.Plain(text=f"[{match.meme_key}] {result}\n"))
+            else:
+                chain.append(result)
+        with metrics.span('reply'):
+            await event_context.reply(platform_message.MessageChain(chain))
+        if not all(isinstance(result, str) for result in results):
+            event_context.prevent_default()
+
+    async def _reply_suggestions(self, event_context, query):
+        """回复与 query 相近的表情包关键词"""
+        with self.metrics.span('search'):
+            suggestions = self.meme_handler.suggest(query, limit=_SEARCH_LIMIT)
+        self.metrics.inc('searches', 'result', 'hit' if suggestions else 'miss')
+        if suggestions:
+            lines = [f"“{query}”相关的表情包："]
+            lines += [f"{i}. {keyword}（{meme_key}）" for i, (keyword, meme_key, _) in enumerate(suggestions, 1)]
+            text = '\n'.join(lines)
+        else:
+            text = f"没有找到与“{query}”相关的表情包"
+        await event_context.reply(
+            platform_message.MessageChain([
+                platform_message.Plain(text=text)
+            ])
+        )
+
     # 匹配关键词，返回对应的meme key
     def _match_keyword(self, text):
-        return self.meme_handler.match_keyword(text)
\ No newline at end of file
+        return self.meme_handler.match_keyword(text)
+
+    async def close(self):
+        """停止后台任务并关闭共享的HTTP客户端，释放连接池"""
+        if self.catalog_refresher is not None:
+            await self.catalog_refresher.stop()
+        if self.prewarmer is not None:
+            # 停止时保存热度，重启后仍能预生成热门表情包
+            await self.prewarmer.stop()
+        if self.metrics_exporter is not None:
+            await self.metrics_exporter.stop()
+        if self.backend_pool is not None:
+            await self.backend_pool.stop()
+        if self.image_codec is not None:
+            self.image_codec.close()
+        client, self.http_client = self.http_client, None
+        if client is not None and not client.is_closed:
+            await client.aclose()
+
+    def __del__(self):
+        # 插件卸载时关闭连接池；没有运行中的事件循环时交给httpx自行回收
+        if self.http_client is None or self.http_client.is_closed:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        loop.create_task(self.close())
\ No newline at end of file
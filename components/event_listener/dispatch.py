@@ -0,0 +1,97 @@
+import re
+
+from .shortcuts import ShortcutMatcher
+
+# 快捷指令的key中出现这些字符时视为正则表达式，由正则匹配器处理
+_REGEX_META = re.compile(r'[\\.^$*+?{}\[\]|()]')
+
+
+def is_literal_pattern(pattern):
+    """判断快捷指令的key是否为普通字面量"""
+    return _REGEX_META.search(pattern) is None
+
+
+class DispatchMatch:
+    """一次分发匹配的结果"""
+
+    __slots__ = ('meme_key', 'spec', 'text', 'shortcut_args')
+
+    def __init__(self, meme_key, spec, text, shortcut_args=None):
+        # 匹配到的表情包key
+        self.meme_key = meme_key
+        # 匹配时所用目录中的表情包规格（目录热更新后仍保持一致）
+        self.spec = spec
+        # 触发词之后的剩余文本
+        self.text = text
+        # 快捷指令附带的参数（如 ['--loop']）
+        self.shortcut_args = shortcut_args or []
+
+    def __repr__(self):
+        return f'DispatchMatch({self.meme_key!r}, {self.text!r}, {self.shortcut_args!r})'
+
+
+class DispatchIndex:
+    """
+    消息分发索引：由表情包key、关键词和字面量快捷指令构建的单次查表索引，
+    正则快捷指令交给预编译的 ShortcutMatcher。
+    不可能是表情包指令的消息在解析、下载头像或请求后端之前就被拒绝。
+    """
+
+    def __init__(self, memes_info):
+        """
+        :param memes_info: {meme_key: MemeSpec}
+        """
+        self._memes_info = memes_info
+        # 触发词 -> (meme_key, 快捷指令参数)
+        self._triggers = {}
+        self.shortcut_matcher = ShortcutMatcher([])
+        self._build(memes_info)
+
+    def _build(self, memes_info):
+        # 优先级：关键词 > 表情包key > 快捷指令（关键词与 keyword_to_key 的覆盖规则一致）
+        for key, spec in memes_info.items():
+            for keyword in spec.keywords:
+                self._triggers[keyword] = (key, None)
+        for key in memes_info:
+            self._triggers.setdefault(key, (key, None))
+        regex_shortcuts = []
+        for key, spec in memes_info.items():
+            for shortcut in spec.shortcuts:
+                pattern = shortcut.get('key')
+                if not pattern:
+                    continue
+                if is_literal_pattern(pattern):
+                    self._triggers.setdefault(pattern, (key, list(shortcut.get('args') or [])))
+                else:
+                    regex_shortcuts.append((key, pattern, shortcut.get('args')))
+        self.shortcut_matcher = ShortcutMatcher(regex_shortcuts)
+
+    def __len__(self):
+        return len(self._triggers)
+
+    def match(self, message_text):
+        """
+        匹配消息
+        :param message_text: 去除AT等元素后的纯文本消息
+        :return: DispatchMatch，不是表情包指令时返回None
+        """
+        message_text = message_text.strip()
+        trigger, _, rest = message_text.partition(' ')
+        entry = self._triggers.get(trigger)
+        if entry is not None:
+            meme_key, shortcut_args = entry
+            return DispatchMatch(meme_key, self._memes_info[meme_key], rest.strip(), shortcut_args)
+
+        shortcut = self.shortcut_matcher.match(message_text)
+        if shortcut is not None:
+            meme_key, shortcut_args, rest = shortcut
+            return DispatchMatch(meme_key, self._memes_info[meme_key], rest, shortcut_args)
+
+        return None
+
+    def stats(self):
+        """返回索引规模"""
+        return {
+            'triggers': len(self._triggers),
+            'regex_shortcuts': len(self.shortcut_matcher),
+        }
@@ -0,0 +1,68 @@
+import asyncio
+from collections import deque
+
+# 每个表情包保留的最近延迟样本数
+_WINDOW = 64
+# 样本不足时不对冲，避免按少量数据估出过短的等待时间
+_MIN_SAMPLES = 10
+
+
+class LatencyTracker:
+    """按表情包记录最近的渲染延迟，用于计算对冲请求的触发时间"""
+
+    def __init__(self, window=_WINDOW):
+        self.window = window
+        self._samples = {}
+        # 所有表情包的样本，单个表情包样本不足时使用
+        self._overall = deque(maxlen=window * 4)
+
+    def record(self, meme_key, seconds):
+        samples = self._samples.get(meme_key)
+        if samples is None:
+            samples = self._samples[meme_key] = deque(maxlen=self.window)
+        samples.append(seconds)
+        self._overall.append(seconds)
+
+    def percentile(self, meme_key, q):
+        """
+        :param q: 分位数（0~1）
+        :return: 延迟估计；样本不足时返回None
+        """
+        samples = self._samples.get(meme_key)
+        if samples is None or len(samples) < _MIN_SAMPLES:
+            samples = self._overall
+            if len(samples) < _MIN_SAMPLES:
+                return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def hedged(fn, delay):
+    """
+    执行 fn()，超过 delay 秒仍未完成时再发起一次相同请求，取先成功的结果
+    :param fn: 无参协程函数，必须是幂等的
+    :param delay: 触发对冲的等待时间，None表示不对冲
+    :return: (结果, 是否发起了对冲请求)
+    """
+    first = asyncio.ensure_future(fn())
+    if delay is None:
+        return await first, False
+
+    tasks = {first}
+    fired = False
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            tasks.add(asyncio.ensure_future(fn()))
+            fired = True
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), fired
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,52 @@
+import logging
+
+import httpx
+
+from .settings import get_number
+
+logger = logging.getLogger(__name__)
+
+# 连接池与超时的默认值，可在 manifest.yaml 的配置项中覆盖
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 20
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 30.0
+
+
+def _http2_available():
+    """HTTP/2 依赖 h2 包，未安装时回退到 HTTP/1.1"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_http_client(config=None, transport=None):
+    """
+    创建插件共享的长连接 HTTP 客户端
+    :param config: 插件配置字典
+    :param transport: 自定义 transport（测试或压测时替换真实网络）
+    :return: httpx.AsyncClient
+    """
+    config = config or {}
+
+    limits = httpx.Limits(
+        max_connections=get_number(config, 'http_max_connections', DEFAULT_MAX_CONNECTIONS, int),
+        max_keepalive_connections=get_number(
+            config, 'http_max_keepalive_connections', DEFAULT_MAX_KEEPALIVE_CONNECTIONS, int
+        ),
+        keepalive_expiry=get_number(config, 'http_keepalive_expiry', DEFAULT_KEEPALIVE_EXPIRY, float),
+    )
+
+    connect_timeout = get_number(config, 'http_connect_timeout', DEFAULT_CONNECT_TIMEOUT, float)
+    read_timeout = get_number(config, 'http_read_timeout', DEFAULT_READ_TIMEOUT, float)
+    timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+
+    http2 = bool(config.get('http2', False))
+    if http2 and not _http2_available():
+        logger.warning("未安装 h2 包，HTTP/2 已禁用（pip install 'httpx[http2]'）")
+        http2 = False
+
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2, transport=transport)
@@ -0,0 +1,55 @@
+import asyncio
+import binascii
+from concurrent.futures import ThreadPoolExecutor
+
+# 超过该字节数的编解码放到线程池执行，避免大图阻塞事件循环
+DEFAULT_OFFLOAD_THRESHOLD = 256 * 1024
+DEFAULT_WORKERS = 2
+
+
+def decode_base64(data):
+    """
+    解码base64图片数据，支持 data URL（data:image/png;base64,...）
+    原实现 split(',') 和 b64decode 内部的 encode 各复制一次整段数据；
+    这里只做一次 str->bytes 转换，去掉前缀用 memoryview 切片，不再复制
+    """
+    raw = data.encode('ascii') if isinstance(data, str) else data
+    view = memoryview(raw)
+    comma = raw.find(b',', 0, 256)
+    if comma >= 0:
+        view = view[comma + 1:]
+    return binascii.a2b_base64(view)
+
+
+def encode_base64(data):
+    """编码为base64字符串"""
+    return binascii.b2a_base64(data, newline=False).decode('ascii')
+
+
+class ImageCodec:
+    """图片base64编解码，大数据量时交给专用线程池"""
+
+    def __init__(self, offload_threshold=DEFAULT_OFFLOAD_THRESHOLD, workers=DEFAULT_WORKERS):
+        self.offload_threshold = offload_threshold
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='meme-codec')
+        self.offloaded = 0
+
+    async def run(self, size, fn, *args):
+        """size 超过阈值时在线程池中执行 fn(*args)，否则直接执行"""
+        if size < self.offload_threshold:
+            return fn(*args)
+        return await self.run_in_pool(fn, *args)
+
+    async def run_in_pool(self, fn, *args):
+        """在线程池中执行 fn(*args)"""
+        self.offloaded += 1
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def decode(self, data):
+        return await self.run(len(data), decode_base64, data)
+
+    async def encode(self, data):
+        return await self.run(len(data), encode_base64, data)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
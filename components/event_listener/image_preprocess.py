@@ -0,0 +1,163 @@
+import io
+import logging
+
+try:
+    from PIL import Image, ImageSequence, features
+except ImportError:  # Pillow 未安装时跳过预处理，原图直接上传
+    Image = None
+
+from .settings import parse_key_values
+
+logger = logging.getLogger(__name__)
+
+# 默认把图片长边缩小到该像素数以内，大多数表情模板只需要 200~500px
+DEFAULT_MAX_SIDE = 512
+# 超过该字节数的静态图片即使不缩放也重新编码
+DEFAULT_TRANSCODE_THRESHOLD = 512 * 1024
+# 有损编码质量
+_QUALITY = 90
+# 小于该字节数的图片（如QQ头像）通常无需处理，直接在事件循环中检查
+_INLINE_LIMIT = 32 * 1024
+
+
+# 按文件头识别图片格式：(文件头, 扩展名, MIME类型)
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png', 'image/png'),
+    (b'\xff\xd8\xff', 'jpg', 'image/jpeg'),
+    (b'GIF87a', 'gif', 'image/gif'),
+    (b'GIF89a', 'gif', 'image/gif'),
+    (b'BM', 'bmp', 'image/bmp'),
+)
+
+
+def image_format(data):
+    """
+    按文件头识别图片格式，用于上传时的文件名和Content-Type
+    :return: (扩展名, MIME类型)，无法识别时按PNG处理
+    """
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp', 'image/webp'
+    for signature, ext, mime in _SIGNATURES:
+        if data.startswith(signature):
+            return ext, mime
+    return 'png', 'image/png'
+
+
+def _encode_static(img):
+    """静态图片编码：优先WebP（支持透明且体积小），否则按是否透明选PNG/JPEG"""
+    out = io.BytesIO()
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    if features.check('webp'):
+        img.convert('RGBA' if has_alpha else 'RGB').save(out, format='WEBP', quality=_QUALITY, method=4)
+    elif has_alpha:
+        img.convert('RGBA').save(out, format='PNG', optimize=True)
+    else:
+        img.convert('RGB').save(out, format='JPEG', quality=_QUALITY)
+    return out.getvalue()
+
+
+def _encode_animated(img, max_side):
+    """逐帧缩放动图并保留帧时长和循环设置"""
+    frames = []
+    durations = []
+    for frame in ImageSequence.Iterator(img):
+        frame = frame.convert('RGBA')
+        frame.thumbnail((max_side, max_side), Image.LANCZOS)
+        frames.append(frame)
+        durations.append(frame.info.get('duration', img.info.get('duration', 100)))
+    out = io.BytesIO()
+    frames[0].save(
+        out, format='GIF', save_all=True, append_images=frames[1:],
+        duration=durations, loop=img.info.get('loop', 0), disposal=2,
+    )
+    return out.getvalue()
+
+
+def preprocess_image(data, max_side, keep_animation, transcode_threshold=DEFAULT_TRANSCODE_THRESHOLD):
+    """
+    缩放/转码单张图片（CPU密集，应在线程池中调用）
+    :param max_side: 长边像素上限，0表示不缩放
+    :param keep_animation: 动图是否保留动画；为False时只取第一帧
+    :return: 处理后的图片数据；无需处理或处理失败时返回原数据
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+        animated = getattr(img, 'is_animated', False)
+        too_large = max_side > 0 and max(img.size) > max_side
+
+        if animated and keep_animation:
+            return _encode_animated(img, max_side) if too_large else data
+
+        if not animated and not too_large and len(data) <= transcode_threshold:
+            return data
+
+        # 静态图或不需要动画的表情：只取第一帧
+        img.seek(0)
+        frame = img.copy()
+        if too_large:
+            frame.thumbnail((max_side, max_side), Image.LANCZOS)
+        result = _encode_static(frame)
+        return result if len(result) < len(data) or too_large or animated else data
+    except Exception as e:
+        logger.warning(f"图片预处理失败，使用原图：{repr(e)}")
+        return data
+
+
+class ImagePreprocessor:
+    """上传前按表情包缩放、转码用户图片"""
+
+    def __init__(self, max_side=DEFAULT_MAX_SIDE, size_overrides=None, static_memes=None,
+                 transcode_threshold=DEFAULT_TRANSCODE_THRESHOLD, codec=None):
+        """
+        :param max_side: 默认长边像素上限
+        :param size_overrides: 按表情包覆盖的长边上限，{meme_key: px} 或 ['meme_key=px', ...]
+        :param static_memes: 不需要动画输入的表情包key，动图只取第一帧
+        :param codec: ImageCodec，用其线程池执行图片处理
+        """
+        self.max_side = max_side
+        if isinstance(size_overrides, dict):
+            self.size_overrides = dict(size_overrides)
+        else:
+            self.size_overrides = parse_key_values(size_overrides, int, '图片尺寸配置')
+        self.static_memes = set(static_memes or [])
+        self.transcode_threshold = transcode_threshold
+        self.codec = codec
+        self.processed = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def available():
+        return Image is not None
+
+    def target_side(self, meme_key):
+        return self.size_overrides.get(meme_key, self.max_side)
+
+    async def prepare(self, meme_key, images):
+        """
+        处理待上传的图片
+        :return: 处理后的图片数据列表
+        """
+        if Image is None or not images:
+            return images
+        max_side = self.target_side(meme_key)
+        keep_animation = meme_key not in self.static_memes
+        results = []
+        for data in images:
+            args = (data, max_side, keep_animation, self.transcode_threshold)
+            if self.codec is not None and len(data) > _INLINE_LIMIT:
+                # 解码大图是CPU密集操作，交给线程池
+                result = await self.codec.run_in_pool(preprocess_image, *args)
+            else:
+                result = preprocess_image(*args)
+            if result is not data:
+                self.processed += 1
+                self.bytes_saved += len(data) - len(result)
+            results.append(result)
+        return results
+
+    def stats(self):
+        """返回预处理统计信息"""
+        return {
+            'processed': self.processed,
+            'bytes_saved': self.bytes_saved,
+        }
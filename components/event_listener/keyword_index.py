@@ -0,0 +1,181 @@
+from bisect import bisect_left
+from collections import Counter
+
+# 自动纠错只接受1处编辑，且关键词至少这么长（短词差一个字往往是完全不同的意思）
+_RESOLVE_MIN_LENGTH = 4
+_PAD = '\x00'
+
+
+def _normalize(text):
+    return text.strip().casefold()
+
+
+def _bigrams(text):
+    """带首尾填充的二元组，长度为 len(text)+1"""
+    padded = f'{_PAD}{text}{_PAD}'
+    return [padded[i:i + 2] for i in range(len(padded) - 1)]
+
+
+def edit_distance(a, b, max_distance):
+    """
+    有界的编辑距离（相邻字符交换算作1次编辑）
+    :return: 距离；超过 max_distance 时返回 max_distance + 1
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    if a == b:
+        return 0
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        row_min = i
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (previous2 is not None and i > 1 and j > 1
+                    and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                value = min(value, previous2[j - 2] + 1)
+            current[j] = value
+            row_min = min(row_min, value)
+        if row_min > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+def default_max_distance(length):
+    """按查询长度放宽允许的编辑次数"""
+    if length < 2:
+        return 0
+    return 1 if length <= 4 else 2
+
+
+class KeywordIndex:
+    """
+    关键词的前缀和模糊匹配索引：
+    有序关键词表用于前缀查找，二元组倒排表用于筛选编辑距离候选，
+    只对共享足够多二元组的关键词计算编辑距离；短查询改用单字倒排表筛选
+    """
+
+    def __init__(self, keyword_to_key):
+        """
+        :param keyword_to_key: {关键词: meme_key}，表情包key本身也可以作为关键词传入
+        """
+        # 归一化关键词 -> (原关键词, meme_key)
+        self._entries = {}
+        for keyword, key in keyword_to_key.items():
+            self._entries.setdefault(_normalize(keyword), (keyword, key))
+        self._sorted = sorted(self._entries)
+        # 二元组 -> [(归一化关键词, 该二元组出现次数), ...]
+        self._grams = {}
+        for normalized in self._sorted:
+            for gram, count in Counter(_bigrams(normalized)).items():
+                self._grams.setdefault(gram, []).append((normalized, count))
+        # 单字 -> [归一化关键词, ...]；长度 -> [归一化关键词, ...]；归一化关键词 -> 各字符的个数
+        self._chars = {}
+        self._lengths = {}
+        self._char_counts = {}
+        for normalized in self._sorted:
+            self._char_counts[normalized] = Counter(normalized)
+            for ch in set(normalized):
+                self._chars.setdefault(ch, []).append(normalized)
+            self._lengths.setdefault(len(normalized), []).append(normalized)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def prefix(self, query, limit=10):
+        """以 query 开头的关键词（按字典序）"""
+        query = _normalize(query)
+        if not query:
+            return []
+        results = []
+        i = bisect_left(self._sorted, query)
+        while i < len(self._sorted) and self._sorted[i].startswith(query) and len(results) < limit:
+            results.append(self._sorted[i])
+            i += 1
+        return results
+
+    def _fuzzy(self, query, max_distance):
+        """返回 {归一化关键词: 编辑距离}，只包含距离不超过 max_distance 的关键词"""
+        if max_distance <= 0:
+            return {query: 0} if query in self._entries else {}
+        counts = {}
+        if len(query) + 1 - 3 * max_distance <= 0:
+            # 查询太短，二元组筛选不起作用（如 “ab” 和 “ba” 不共享二元组）。
+            # 不共享任何字符的两个词距离不小于较长一方的长度，所以候选只需取
+            # 共享字符且长度相差不超过 max_distance 的关键词
+            lengths = range(len(query) - max_distance, len(query) + max_distance + 1)
+            for ch in set(query):
+                for normalized in self._chars.get(ch, ()):
+                    if len(normalized) in lengths:
+                        counts[normalized] = 0
+            if len(query) <= max_distance:
+                for length in lengths:
+                    for normalized in self._lengths.get(length, ()):
+                        counts[normalized] = 0
+        for gram, query_count in Counter(_bigrams(query)).items():
+            for normalized, count in self._grams.get(gram, ()):
+                counts[normalized] = counts.get(normalized, 0) + min(query_count, count)
+        query_chars = Counter(query).items()
+        results = {}
+        for normalized, shared in counts.items():
+            longest = max(len(query), len(normalized))
+            # 每次编辑最多破坏3个二元组（相邻交换），共享数不够的候选不可能在距离内
+            if shared < longest + 1 - 3 * max_distance or abs(len(query) - len(normalized)) > max_distance:
+                continue
+            # 每次编辑最多改变1个字符（相邻交换不改变字符），共享字符不够的也可以跳过
+            char_counts = self._char_counts[normalized]
+            if sum(min(count, char_counts.get(ch, 0)) for ch, count in query_chars) < longest - max_distance:
+                continue
+            distance = edit_distance(query, normalized, max_distance)
+            if distance <= max_distance:
+                results[normalized] = distance
+        return results
+
+    def suggest(self, query, limit=5, max_distance=None):
+        """
+        按相似度排序的候选表情包
+        :return: [(关键词, meme_key, 编辑距离), ...]，同一表情包只保留最接近的关键词；
+                 前缀匹配的编辑距离记为0
+        """
+        query = _normalize(query)
+        if not query:
+            return []
+        if max_distance is None:
+            max_distance = default_max_distance(len(query))
+        scored = {}
+        for normalized, distance in self._fuzzy(query, max_distance).items():
+            scored[normalized] = (distance, 0, len(normalized))
+        for normalized in self.prefix(query, limit=limit * 4):
+            # 前缀补全排在精确匹配之后，短的优先
+            scored.setdefault(normalized, (0, 1, len(normalized)))
+
+        results = []
+        seen = set()
+        for normalized, score in sorted(scored.items(), key=lambda item: (item[1], item[0])):
+            keyword, key = self._entries[normalized]
+            if key in seen:
+                continue
+            seen.add(key)
+            results.append((keyword, key, score[0]))
+            if len(results) >= limit:
+                break
+        return results
+
+    def resolve(self, query):
+        """
+        安全的自动纠错：只有1处编辑、足够长且所有距离为1的候选都指向同一个表情包时才返回
+        :return: meme_key 或 None
+        """
+        query = _normalize(query)
+        entry = self._entries.get(query)
+        if entry is not None:
+            return entry[1]
+        if len(query) < _RESOLVE_MIN_LENGTH:
+            return None
+        keys = {self._entries[normalized][1] for normalized in self._fuzzy(query, 1)}
+        if len(keys) == 1:
+            return keys.pop()
+        return None
@@ -0,0 +1,274 @@
+import logging
+import marshal
+import os
+import struct
+import sys
+import time
+from pathlib import Path
+
+import yaml
+
+from .dispatch import DispatchIndex
+from .keyword_index import KeywordIndex
+from .storage import atomic_open
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = Path(__file__).parent.parent.parent / "data"
+# 表情包信息文件路径
+MEMES_INFO_FILE = DATA_DIR / "memes_info.yaml"
+# 二进制快照文件路径
+SNAPSHOT_FILE = DATA_DIR / "memes_info.snapshot"
+
+# 快照文件格式：魔数 + 格式版本 + Python版本 + 热数据长度 + 热数据 + 各表情包的冷数据
+# 热数据和冷数据都使用 marshal 序列化（只含基础类型，加载速度远快于 YAML 和 pickle）
+SNAPSHOT_MAGIC = b'MEMESNAP'
+SNAPSHOT_VERSION = 1
+_HEADER = struct.Struct('<8sIBBQ')
+
+# 优先使用 libyaml 的C实现
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# 输出用纯Python实现，libyaml会把emoji等字符转义，和已有文件格式不一致
+_YamlDumper = yaml.SafeDumper
+
+
+class MemeSpec:
+    """表情包规格，只常驻热路径用到的字段，参数模型等冷数据按需加载"""
+
+    __slots__ = (
+        'key', 'keywords', 'min_texts', 'max_texts', 'min_images', 'max_images',
+        'default_texts', 'shortcuts', 'date_modified', '_extra', '_extra_loader',
+    )
+
+    def __init__(self, key, keywords=(), min_texts=0, max_texts=0, min_images=0, max_images=0,
+                 default_texts=(), shortcuts=(), date_modified=None, extra=None, extra_loader=None):
+        self.key = key
+        self.keywords = tuple(keywords)
+        self.min_texts = min_texts
+        self.max_texts = max_texts
+        self.min_images = min_images
+        self.max_images = max_images
+        self.default_texts = tuple(default_texts)
+        self.shortcuts = tuple(shortcuts)
+        self.date_modified = date_modified
+        self._extra = extra
+        self._extra_loader = extra_loader
+
+    @classmethod
+    def from_info(cls, key, meme_info):
+        """从 memes_info.yaml 中单个表情包的信息构建"""
+        params_type = meme_info.get('params_type') or {}
+        return cls(
+            key,
+            keywords=meme_info.get('keywords') or (),
+            min_texts=params_type.get('min_texts', 0),
+            max_texts=params_type.get('max_texts', 0),
+            min_images=params_type.get('min_images', 0),
+            max_images=params_type.get('max_images', 0),
+            default_texts=params_type.get('default_texts') or (),
+            shortcuts=[
+                {'key': s.get('key'), 'args': list(s.get('args') or []), 'humanized': s.get('humanized')}
+                for s in meme_info.get('shortcuts') or []
+            ],
+            date_modified=meme_info.get('date_modified'),
+            extra=_split_extra(meme_info),
+        )
+
+    @property
+    def extra(self):
+        """冷数据：args_type（参数模型、解析选项）、tags、date_created 等"""
+        if self._extra is None:
+            self._extra = self._extra_loader() if self._extra_loader is not None else {}
+            self._extra_loader = None
+        return self._extra
+
+    @property
+    def args_type(self):
+        return self.extra.get('args_type') or {}
+
+    @property
+    def parser_options(self):
+        return self.args_type.get('parser_options') or []
+
+    def to_info(self):
+        """还原为 memes_info.yaml 中的字典格式"""
+        extra = dict(self.extra)
+        params_type = {
+            'args_type': extra.pop('args_type', None),
+            'default_texts': list(self.default_texts),
+            'max_images': self.max_images,
+            'max_texts': self.max_texts,
+            'min_images': self.min_images,
+            'min_texts': self.min_texts,
+        }
+        info = {
+            'keywords': list(self.keywords),
+            'params_type': params_type,
+            'shortcuts': [dict(s) for s in self.shortcuts],
+        }
+        if self.date_modified is not None:
+            info['date_modified'] = self.date_modified
+        info.update(extra)
+        return info
+
+    def __repr__(self):
+        return f'MemeSpec({self.key!r})'
+
+
+def _split_extra(meme_info):
+    """取出不在热路径上的字段"""
+    extra = {k: v for k, v in meme_info.items() if k not in ('keywords', 'params_type', 'shortcuts', 'date_modified')}
+    extra['args_type'] = (meme_info.get('params_type') or {}).get('args_type')
+    return extra
+
+
+def _hot_tuple(spec):
+    return (
+        spec.key, list(spec.keywords), spec.min_texts, spec.max_texts, spec.min_images,
+        spec.max_images, list(spec.default_texts), [dict(s) for s in spec.shortcuts], spec.date_modified,
+    )
+
+
+def _source_fingerprint(path):
+    """源YAML文件的指纹（大小+修改时间），用于判断快照是否过期"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def write_snapshot(specs, path=SNAPSHOT_FILE, source=MEMES_INFO_FILE):
+    """
+    写入二进制快照（先写临时文件再原子替换）
+    :param specs: {meme_key: MemeSpec}
+    """
+    path = Path(path)
+    blobs = []
+    offsets = []
+    offset = 0
+    for spec in specs.values():
+        blob = marshal.dumps(spec.extra)
+        blobs.append(blob)
+        offsets.append((offset, len(blob)))
+        offset += len(blob)
+
+    hot = marshal.dumps({
+        'source': _source_fingerprint(source),
+        'memes': [_hot_tuple(spec) + offsets[i] for i, spec in enumerate(specs.values())],
+    })
+    header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, sys.version_info[0], sys.version_info[1], len(hot))
+
+    with atomic_open(path) as f:
+        f.write(header)
+        f.write(hot)
+        for blob in blobs:
+            f.write(blob)
+
+
+def _extra_loader(cold, offset, length):
+    def load():
+        return marshal.loads(cold[offset:offset + length])
+    return load
+
+
+def read_snapshot(path=SNAPSHOT_FILE, source=MEMES_INFO_FILE):
+    """
+    读取二进制快照
+    :return: {meme_key: MemeSpec}；快照不存在、版本不符或已过期时返回None
+    """
+    path = Path(path)
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                return None
+            magic, version, major, minor, hot_len = _HEADER.unpack(header)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                return None
+            # marshal 格式与Python版本相关
+            if (major, minor) != sys.version_info[:2]:
+                return None
+            hot = marshal.loads(f.read(hot_len))
+            # 冷数据整块读入（不反序列化），快照文件之后被替换也不影响已加载的目录
+            cold = memoryview(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    fingerprint = _source_fingerprint(source)
+    if fingerprint is not None and hot.get('source') != fingerprint:
+        return None
+
+    specs = {}
+    for (key, keywords, min_texts, max_texts, min_images, max_images,
+         default_texts, shortcuts, date_modified, offset, length) in hot['memes']:
+        specs[key] = MemeSpec(
+            key, keywords, min_texts, max_texts, min_images, max_images,
+            default_texts, shortcuts, date_modified,
+            extra_loader=_extra_loader(cold, offset, length),
+        )
+    return specs
+
+
+def load_yaml(path=MEMES_INFO_FILE):
+    """解析 memes_info.yaml，返回 {meme_key: MemeSpec}"""
+    with open(path, 'r', encoding='utf-8') as f:
+        memes_info = yaml.load(f, Loader=_YamlLoader) or {}
+    return {key: MemeSpec.from_info(key, meme_info) for key, meme_info in memes_info.items()}
+
+
+def save_yaml(memes_info, path=MEMES_INFO_FILE):
+    """
+    保存 memes_info.yaml（key一级格式），先写临时文件再替换，避免中途失败留下不完整的文件
+    :param memes_info: {meme_key: info字典}
+    """
+    with atomic_open(path, 'w', encoding='utf-8') as f:
+        yaml.dump(memes_info, f, Dumper=_YamlDumper, allow_unicode=True, default_flow_style=False)
+
+
+def load_catalog(path=MEMES_INFO_FILE, snapshot_path=SNAPSHOT_FILE):
+    """
+    加载表情包目录：优先使用有效的二进制快照，否则解析YAML并重建快照
+    :return: {meme_key: MemeSpec}
+    """
+    specs = read_snapshot(snapshot_path, path)
+    if specs is not None:
+        return specs
+
+    specs = load_yaml(path)
+    try:
+        write_snapshot(specs, snapshot_path, path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"写入表情包信息快照失败：{repr(e)}")
+    return specs
+
+
+class MemeCatalog:
+    """
+    表情包目录及其派生索引的不可变快照。
+    热更新时在事件循环之外构建新目录，再整体替换引用，处理中的请求始终看到完整一致的索引。
+    """
+
+    __slots__ = ('memes_info', 'keyword_to_key', 'dispatch_index', 'keyword_index', 'built_at')
+
+    def __init__(self, memes_info):
+        """
+        :param memes_info: {meme_key: MemeSpec}
+        """
+        self.memes_info = memes_info
+        # 构建关键词到key的映射
+        self.keyword_to_key = {}
+        for key, spec in memes_info.items():
+            for keyword in spec.keywords:
+                self.keyword_to_key[keyword] = key
+        # 构建消息分发索引（关键词、表情包key、快捷指令）
+        self.dispatch_index = DispatchIndex(memes_info)
+        # 前缀/模糊匹配索引（关键词优先，其次表情包key），用于纠错和搜索建议
+        triggers = dict(self.keyword_to_key)
+        for key in memes_info:
+            triggers.setdefault(key, key)
+        self.keyword_index = KeywordIndex(triggers)
+        self.built_at = time.time()
+
+    def __len__(self):
+        return len(self.memes_info)
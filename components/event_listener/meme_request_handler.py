@@ -1,70 +1,236 @@
-import base64
 import json
-from io import BytesIO
-from pathlib import Path
+import logging
+import re
+import time
 
 import httpx
-import yaml
 
-# 表情包信息文件路径
-MEMES_INFO_FILE = Path(__file__).parent.parent.parent / "data" / "memes_info.yaml"
+from .backend_pool import BackendPool, NoBackendAvailableError, parse_backend_urls
+from .dispatch import DispatchMatch
+from .hedging import LatencyTracker, hedged
+from .image_preprocess import image_format
+from .meme_catalog import MEMES_INFO_FILE, SNAPSHOT_FILE, MemeCatalog, load_catalog
+from .result_cache import make_cache_key
+from .shortcuts import parse_shortcut_args
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# 默认的生成结果大小上限（与后端 GIF_MAX_SIZE 默认值一致）
+DEFAULT_MAX_RESPONSE_BYTES = 10 * 1024 * 1024
+# 所有后端都连接失败/网关错误时的整体重试次数（渲染是幂等的）
+DEFAULT_RENDER_RETRIES = 1
+# 对冲请求的最短等待时间（秒）
+DEFAULT_HEDGE_MIN_DELAY = 1.0
+# 超过该长度的首个词不做模糊匹配（关键词都很短，长句不可能是手误）
+_MAX_FUZZY_TRIGGER = 16
+# 多表情包指令中分隔表情包关键词的符号（半角、全角加号）
+_FANOUT_SEPARATOR = re.compile(r'[+＋]')
+
+
+class MemeTooLargeError(RuntimeError):
+    """生成结果超过大小上限"""
+
+    def __init__(self, size):
+        super().__init__(f"生成的表情包过大（{size / 1024 / 1024:.1f}MB），已取消发送")
+        self.size = size
 
 
 class MemeRequestHandler:
-    def __init__(self, memeurl=None):
-        self.memes_info = {}
-        self.keyword_to_key = {}
-        # 默认API URL
-        self.memeurl = memeurl or "http://127.0.0.1:2233"
+    def __init__(self, memeurl=None, client=None, max_response_bytes=DEFAULT_MAX_RESPONSE_BYTES,
+                 preprocessor=None, metrics=None, backends=None, retries=DEFAULT_RENDER_RETRIES,
+                 hedge_percentile=0, hedge_min_delay=DEFAULT_HEDGE_MIN_DELAY, fuzzy_dispatch=False):
+        # 当前的表情包目录，热更新时整体替换
+        self.catalog = MemeCatalog({})
+        # 分发统计
+        self.dispatch_matched = 0
+        self.dispatch_rejected = 0
+        self.fuzzy_matched = 0
+        self.fanout_matched = 0
+        # 精确匹配失败时是否尝试纠正关键词的手误
+        self.fuzzy_dispatch = fuzzy_dispatch
+        # 表情包后端（支持多个实例，按负载路由并熔断故障实例）
+        self.backends = backends or BackendPool(parse_backend_urls(memeurl))
+        # 默认API URL（第一个后端，保留给旧代码使用）
+        self.memeurl = self.backends.backends[0].url
+        # 共享的HTTP客户端，由插件统一创建和关闭
+        self.client = client
+        # 合并相同输入的并发生成请求
+        self.singleflight = SingleFlight()
+        # 生成结果的大小上限（字节），0表示不限制
+        self.max_response_bytes = max_response_bytes
+        # 可选的图片预处理（上传前缩放、转码）
+        self.preprocessor = preprocessor
+        # 可选的指标记录（后端渲染错误按类型计数）
+        self.metrics = metrics
+        # 连接失败/网关错误时的整体重试次数
+        self.retries = retries
+        # 渲染耗时超过该表情包最近延迟的此分位数（0~1）时发起对冲请求，0表示关闭
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.latency = LatencyTracker()
+        self.hedged = 0
         # 加载表情包信息
         self._load_memes_info()
+
+    @property
+    def memes_info(self):
+        return self.catalog.memes_info
+
+    @property
+    def keyword_to_key(self):
+        return self.catalog.keyword_to_key
+
+    @property
+    def dispatch_index(self):
+        return self.catalog.dispatch_index
     
     def _load_memes_info(self):
-        """加载表情包信息（key一级格式）"""
+        """加载表情包信息（优先使用二进制快照，{meme_key: MemeSpec}）"""
         try:
-            if MEMES_INFO_FILE.exists():
-                with open(MEMES_INFO_FILE, 'r', encoding='utf-8') as f:
-                    # 直接加载为字典格式
-                    self.memes_info = yaml.safe_load(f) or {}
-                
-                # 构建关键词到key的映射
-                self.keyword_to_key = {}
-                for key, meme_info in self.memes_info.items():
-                    if 'keywords' in meme_info:
-                        for keyword in meme_info['keywords']:
-                            self.keyword_to_key[keyword] = key
+            if MEMES_INFO_FILE.exists() or SNAPSHOT_FILE.exists():
+                self.catalog = MemeCatalog(load_catalog())
                 
-                print(f"成功加载 {len(self.memes_info)} 个表情包信息")
-                print(f"成功构建 {len(self.keyword_to_key)} 个关键词映射")
+                logger.info(
+                    "成功加载 %d 个表情包信息，构建 %d 个关键词映射",
+                    len(self.memes_info), len(self.keyword_to_key),
+                )
             else:
-                print(f"表情包信息文件不存在: {MEMES_INFO_FILE}")
-                print("请先运行 utils/fetch_meme_info.py 脚本获取表情包信息")
+                logger.warning(
+                    "表情包信息文件不存在: %s，请先运行 utils/fetch_meme_info.py 脚本获取表情包信息",
+                    MEMES_INFO_FILE,
+                )
         except Exception as e:
-            print(f"加载表情包信息失败: {str(e)}")
-            self.memes_info = {}
-            self.keyword_to_key = {}
+            logger.error(f"加载表情包信息失败: {str(e)}")
+            self.catalog = MemeCatalog({})
+
+    def swap_catalog(self, catalog):
+        """原子替换表情包目录（单次引用赋值，无需加锁）"""
+        self.catalog = catalog
     
+    def dispatch(self, message_text, count_rejected=True):
+        """
+        匹配整条消息，返回DispatchMatch；不是表情包指令时返回None
+        :param count_rejected: 未匹配时是否计入 dispatch_rejected；
+                               之后还要尝试多表情包指令时传False，由 dispatch_many 计数
+        """
+        catalog = self.catalog
+        match = catalog.dispatch_index.match(message_text)
+        if match is None and self.fuzzy_dispatch:
+            match = self._fuzzy_dispatch(catalog, message_text)
+        if match is not None:
+            self.dispatch_matched += 1
+        elif count_rejected:
+            self.dispatch_rejected += 1
+        return match
+
+    def dispatch_many(self, message_text, max_memes, count_rejected=True):
+        """
+        匹配多表情包指令（如 “摸+举牌 文本”）：首个词用加号连接多个触发词
+        :param max_memes: 最多允许的表情包数
+        :param count_rejected: 未匹配时是否计入 dispatch_rejected
+        :return: DispatchMatch 列表（共用同一段文本）；任一触发词无法匹配时返回None
+        """
+        matches = self._match_many(message_text, max_memes)
+        if matches is not None:
+            self.fanout_matched += 1
+        elif count_rejected:
+            self.dispatch_rejected += 1
+        return matches
+
+    def _match_many(self, message_text, max_memes):
+        trigger, _, rest = message_text.strip().partition(' ')
+        if '+' not in trigger and '＋' not in trigger:
+            return None
+        parts = _FANOUT_SEPARATOR.split(trigger)
+        if len(parts) < 2 or len(parts) > max_memes or not all(parts):
+            return None
+        catalog = self.catalog
+        rest = rest.strip()
+        matches = []
+        for part in parts:
+            match = catalog.dispatch_index.match(part)
+            if match is None and self.fuzzy_dispatch:
+                match = self._fuzzy_dispatch(catalog, part)
+            # 每个部分都必须是完整的触发词，避免普通聊天（如 “1+1”）被当成指令
+            if match is None or match.text:
+                return None
+            matches.append(DispatchMatch(match.meme_key, match.spec, rest, match.shortcut_args))
+        return matches
+
+    def _fuzzy_dispatch(self, catalog, message_text):
+        """把首个词按关键词索引纠错（只接受无歧义的1处手误）"""
+        trigger, _, rest = message_text.strip().partition(' ')
+        if not trigger or len(trigger) > _MAX_FUZZY_TRIGGER:
+            return None
+        meme_key = catalog.keyword_index.resolve(trigger)
+        if meme_key is None:
+            return None
+        self.fuzzy_matched += 1
+        logger.debug('关键词纠错：%s -> %s', trigger, meme_key)
+        return DispatchMatch(meme_key, catalog.memes_info[meme_key], rest.strip())
+
     def match_keyword(self, text):
         """匹配关键词，返回对应的meme key"""
         # 精确匹配
         if text in self.keyword_to_key:
             return self.keyword_to_key[text]
         
-        # 模糊匹配（可选）
-        # for keyword, key in self.keyword_to_key.items():
-        #     if keyword in text:
-        #         return key
-        
-        return None
+        # 模糊匹配：通过预建的关键词索引纠正手误，不再逐个扫描关键词
+        return self.catalog.keyword_index.resolve(text)
+
+    def suggest(self, query, limit=5):
+        """
+        搜索相近的表情包
+        :return: [(关键词, meme_key, 编辑距离), ...]，按相似度排序
+        """
+        return self.catalog.keyword_index.suggest(query, limit=limit)
     
-    async def generate_meme(self, meme_key, texts, images):
+    def parse_shortcut_args(self, spec, shortcut_args):
+        """
+        把快捷指令参数映射为后端请求参数
+        :param spec: 表情包规格 MemeSpec
+        :return: (位置参数文本列表, args字典)
+        """
+        if not shortcut_args:
+            return [], {}
+        # parser_options 属于冷数据，只在用到快捷指令参数时才加载
+        return parse_shortcut_args(shortcut_args, spec.parser_options)
+
+    def stats(self):
+        """返回目录和分发统计信息"""
+        return {
+            'catalog_size': len(self.catalog),
+            'keywords': len(self.catalog.keyword_to_key),
+            'catalog_built_at': self.catalog.built_at,
+            'dispatch_matched': self.dispatch_matched,
+            'dispatch_rejected': self.dispatch_rejected,
+            'fuzzy_matched': self.fuzzy_matched,
+            'fanout_matched': self.fanout_matched,
+            **self.catalog.dispatch_index.stats(),
+            **{f'singleflight_{k}': v for k, v in self.singleflight.stats().items()},
+            **{f'backend_{k}': v for k, v in self.backends.stats().items()},
+            'hedged': self.hedged,
+        }
+
+    async def generate_meme(self, meme_key, texts, images, args=None, request_key=None):
         """
-        生成表情包
+        生成表情包，相同输入的并发请求合并为一次后端调用
         :param meme_key: 表情包key
         :param texts: 文本内容列表
         :param images: 图片二进制数据列表
+        :param args: 额外参数字典（如快捷指令映射出的 character、loop）
+        :param request_key: 请求的内容摘要（即结果缓存key），为None时自动计算
         :return: 生成的图片二进制数据
         """
+        if request_key is None:
+            request_key = make_cache_key(meme_key, texts, args, images)
+        return await self.singleflight.do(
+            request_key, lambda: self._generate_meme(meme_key, texts, images, args)
+        )
+
+    async def _generate_meme(self, meme_key, texts, images, args=None):
+        """请求后端生成表情包"""
         try:
             # 构建API请求参数 - 符合curl请求示例格式
             # 准备files参数用于文件上传
@@ -72,26 +238,34 @@ class MemeRequestHandler:
             # 决定是否需要发送图片
             need_send_images = False
             if meme_key in self.memes_info:
-                meme_info = self.memes_info[meme_key]
-                min_images = meme_info.get('params_type', {}).get('min_images', 0)
-                max_images = meme_info.get('params_type', {}).get('max_images', 0)
+                spec = self.memes_info[meme_key]
+                min_images = spec.min_images
+                max_images = spec.max_images
                 
                 # 只有当表情包需要图片时才发送图片
                 need_send_images = min_images > 0 or max_images > 0
                 
-                print(f'meme_key={meme_key}, min_images={min_images}, max_images={max_images}, need_send_images={need_send_images}')
+                # 日志参数延迟格式化，未开启DEBUG时几乎没有开销
+                logger.debug(
+                    'meme_key=%s, min_images=%d, max_images=%d, need_send_images=%s',
+                    meme_key, min_images, max_images, need_send_images,
+                )
             
             # 如果需要发送图片且有图片数据
             if need_send_images and images:
+                # 上传前按表情包缩小、转码图片，减少上传和后端解码开销
+                if self.preprocessor is not None:
+                    images = await self.preprocessor.prepare(meme_key, images)
                 # 处理多个图片，使用列表格式，这是httpx发送多个相同字段名的正确方式
                 for i, img_data in enumerate(images):
-                    # 创建一个BytesIO对象来模拟文件上传
-                    img_file = BytesIO(img_data)
-                    # 使用元组格式添加到files列表
-                    files.append(('images', (f'image_{i}.png', img_file, 'image/png')))
-                print(f'发送图片数量: {len(files)}')
+                    # 直接上传bytes，不再额外包一层BytesIO；预处理后可能是WebP/JPEG，按实际格式标注
+                    ext, mime = image_format(img_data)
+                    files.append(('images', (f'image_{i}.{ext}', img_data, mime)))
+                logger.debug('发送图片数量: %d', len(files))
             else:
-                print(f'不发送图片，need_send_images={need_send_images}, 图片数量={len(images) if images else 0}')
+                logger.debug(
+                    '不发送图片，need_send_images=%s, 图片数量=%d', need_send_images, len(images) if images else 0
+                )
             
             # 准备data参数
             data = {}
@@ -102,11 +276,10 @@ class MemeRequestHandler:
                 data['texts'] = texts
             
             # 添加args参数 - 使用JSON字符串格式
-            args = '{"user_infos":[]}'
-            data['args'] = args
+            data['args'] = json.dumps({'user_infos': [], **(args or {})}, ensure_ascii=False)
             
-            # 构建API URL
-            url = f"{self.memeurl}/memes/{meme_key}/"
+            # 构建API路径，后端地址由后端池按负载选择
+            path = f"/memes/{meme_key}/"
             # print(f'API请求URL：{url}')
             # print(f'匹配到的关键词：{meme_key}')
             # print(f'发送的文本数量：{len(texts)}')
@@ -117,16 +290,19 @@ class MemeRequestHandler:
                 'accept': 'application/json'
             }
             
-            # 发送API请求
+            # 发送API请求（复用共享连接池），返回生成的图片二进制数据
+            # 连接错误和 502/503/504 时自动切换到其他后端
+            if self.client is not None:
+                return await self._render(
+                    meme_key, lambda base_url: self._post(self.client, f"{base_url}{path}", files, data, headers)
+                )
             async with httpx.AsyncClient() as client:
-                resp = await client.post(url, files=files, data=data, headers=headers)
-            
-            # 检查响应状态
-            resp.raise_for_status()
-            
-            # 返回生成的图片二进制数据
-            return resp.content
+                return await self._render(
+                    meme_key, lambda base_url: self._post(client, f"{base_url}{path}", files, data, headers)
+                )
             
+        except (MemeTooLargeError, NoBackendAvailableError):
+            raise
         except httpx.HTTPStatusError as e:
             # print(f"生成表情包时出错：HTTP错误 {e.response.status_code}")
             # print("响应内容：", e.response.text)
@@ -134,8 +310,54 @@ class MemeRequestHandler:
             #     raise ValueError(f"未找到表情包：{meme_key}")
             # else:
             #     raise RuntimeError(f"生成表情包时出错：HTTP错误 {e.response.status_code}")
+            self._record_error(f'http_{e.response.status_code}')
+            logger.debug('生成表情包时出错（%s）：HTTP错误 %d', meme_key, e.response.status_code)
             return
         except Exception as e:
             # print(f"生成表情包时出错：{str(e)}")
             # raise RuntimeError(f"生成表情包时出错：{str(e)}")
-            return
\ No newline at end of file
+            self._record_error(type(e).__name__)
+            logger.debug('生成表情包时出错（%s）：%r', meme_key, e)
+            return
+
+    async def _render(self, meme_key, post):
+        """
+        经后端池发送渲染请求：失败时有限次重试，慢请求可选对冲
+        :param post: 协程函数 post(base_url)
+        """
+        delay = None
+        if self.hedge_percentile > 0:
+            estimate = self.latency.percentile(meme_key, self.hedge_percentile)
+            if estimate is not None:
+                delay = max(self.hedge_min_delay, estimate)
+
+        started = time.monotonic()
+        result, fired = await hedged(lambda: self.backends.request(post, self.retries), delay)
+        if fired:
+            self.hedged += 1
+        self.latency.record(meme_key, time.monotonic() - started)
+        return result
+
+    def _record_error(self, error_type):
+        if self.metrics is not None:
+            self.metrics.inc('render_errors', 'type', error_type)
+
+    async def _post(self, client, url, files, data, headers):
+        """流式读取生成结果，超过大小上限时在缓冲整个响应之前中止"""
+        async with client.stream('POST', url, files=files, data=data, headers=headers) as resp:
+            # 检查响应状态
+            resp.raise_for_status()
+
+            limit = self.max_response_bytes
+            content_length = resp.headers.get('content-length')
+            if limit and content_length and content_length.isdigit() and int(content_length) > limit:
+                raise MemeTooLargeError(int(content_length))
+
+            chunks = []
+            size = 0
+            async for chunk in resp.aiter_bytes():
+                size += len(chunk)
+                if limit and size > limit:
+                    raise MemeTooLargeError(size)
+                chunks.append(chunk)
+            return chunks[0] if len(chunks) == 1 else b''.join(chunks)
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+from .storage import atomic_open
+
+logger = logging.getLogger(__name__)
+
+# 延迟直方图的桶上限（秒），覆盖从查表（微秒级）到后端渲染（数十秒）
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+DEFAULT_METRICS_FILE = Path(__file__).parent.parent.parent / 'data' / 'metrics.prom'
+DEFAULT_METRICS_HOST = '127.0.0.1'
+
+
+class Histogram:
+    """固定桶的延迟直方图（Prometheus 风格，桶计数在输出时累加）"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # 最后一个位置是 +Inf 桶
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """按桶估算分位数（在桶内线性插值）"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Span:
+    """
+    计时区间，退出时把耗时记入对应阶段的直方图
+    用法：with metrics.span('render'): ...
+    """
+
+    __slots__ = ('_histogram', '_started')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._started)
+        return False
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+class Metrics:
+    """
+    插件指标：各处理阶段的延迟直方图、按表情包和错误类型的计数器，
+    以及各组件 stats() 的快照（作为 gauge 输出）
+    """
+
+    def __init__(self, prefix='meme'):
+        self.prefix = prefix
+        # {stage: Histogram}
+        self.stages = {}
+        # {(name, label_name, label_value): count}
+        self.counters = {}
+        # {component: 返回统计字典的无参函数}
+        self.collectors = {}
+
+    def histogram(self, stage):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        return histogram
+
+    def span(self, stage):
+        """返回一个记录 stage 阶段耗时的上下文管理器"""
+        return Span(self.histogram(stage))
+
+    def observe(self, stage, seconds):
+        self.histogram(stage).observe(seconds)
+
+    def inc(self, name, label_name, label_value, amount=1):
+        """计数器加一，如 inc('requests', 'meme_key', 'petpet')"""
+        key = (name, label_name, label_value)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def register(self, component, collector):
+        """注册组件的统计函数，抓取时调用"""
+        self.collectors[component] = collector
+
+    def _collect(self):
+        gauges = {}
+        for component, collector in self.collectors.items():
+            try:
+                stats = collector()
+            except Exception as e:
+                logger.warning(f"读取 {component} 统计信息失败：{repr(e)}")
+                continue
+            for key, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges[f'{component}_{key}'] = value
+        return gauges
+
+    def snapshot(self):
+        """返回可JSON序列化的指标快照"""
+        counters = {}
+        for (name, label_name, label_value), value in self.counters.items():
+            counters.setdefault(name, {})[f'{label_name}={label_value}'] = value
+        return {
+            'stages': {
+                stage: {
+                    'count': h.count,
+                    'sum': h.sum,
+                    'p50': h.quantile(0.5),
+                    'p90': h.quantile(0.9),
+                    'p99': h.quantile(0.99),
+                }
+                for stage, h in self.stages.items()
+            },
+            'counters': counters,
+            'gauges': self._collect(),
+        }
+
+    def render_prometheus(self):
+        """以 Prometheus 文本格式输出全部指标"""
+        prefix = self.prefix
+        lines = []
+        if self.stages:
+            name = f'{prefix}_stage_seconds'
+            lines.append(f'# HELP {name} Latency of each message handling stage.')
+            lines.append(f'# TYPE {name} histogram')
+            for stage, h in sorted(self.stages.items()):
+                label = f'stage="{_escape(stage)}"'
+                cumulative = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{label},le="+Inf"}} {h.count}')
+                lines.append(f'{name}_sum{{{label}}} {h.sum!r}')
+                lines.append(f'{name}_count{{{label}}} {h.count}')
+
+        counters = {}
+        for key, value in self.counters.items():
+            counters.setdefault(key[0], []).append((key[1], key[2], value))
+        for counter, samples in sorted(counters.items()):
+            name = f'{prefix}_{counter}_total'
+            lines.append(f'# TYPE {name} counter')
+            for label_name, label_value, value in sorted(samples, key=lambda s: str(s[1])):
+                lines.append(f'{name}{{{label_name}="{_escape(label_value)}"}} {_format_value(value)}')
+
+        for gauge, value in sorted(self._collect().items()):
+            name = f'{prefix}_{gauge}'
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    """
+    指标导出：定期写入文本文件（可配合 node_exporter textfile collector），
+    和/或在本地端口提供 GET /metrics 抓取
+    """
+
+    def __init__(self, metrics, port=0, host=DEFAULT_METRICS_HOST, dump_interval=0,
+                 dump_file=DEFAULT_METRICS_FILE):
+        """
+        :param port: 抓取端口，0表示不监听
+        :param dump_interval: 写文件间隔（秒），0表示不写文件
+        """
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self.dump_interval = dump_interval
+        self.dump_file = Path(dump_file)
+        self._server = None
+        self._task = None
+
+    async def start(self):
+        if self.port:
+            try:
+                self._server = await asyncio.start_server(self._serve, self.host, self.port)
+                logger.info(f"指标抓取地址：http://{self.host}:{self.port}/metrics")
+            except OSError as e:
+                logger.error(f"监听指标端口失败：{repr(e)}")
+        if self.dump_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._dump_loop())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        server, self._server = self._server, None
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+    def dump(self):
+        """原子写入指标文件"""
+        with atomic_open(self.dump_file, 'w', encoding='utf-8') as f:
+            f.write(self.metrics.render_prometheus())
+
+    async def _dump_loop(self):
+        while True:
+            await asyncio.sleep(self.dump_interval)
+            try:
+                self.dump()
+            except OSError as e:
+                logger.warning(f"写入指标文件失败：{repr(e)}")
+
+    async def _serve(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # 读完请求头，忽略内容
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.metrics.render_prometheus().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n'.encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
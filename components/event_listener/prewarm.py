@@ -0,0 +1,215 @@
+import asyncio
+import json
+import logging
+import time
+from pathlib import Path
+
+from .result_cache import make_cache_key
+from .storage import atomic_open
+
+logger = logging.getLogger(__name__)
+
+# 默认预生成的表情包数、内存上限和重新生成间隔（秒）
+DEFAULT_TOP_N = 20
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_INTERVAL = 1800.0
+# 热度的半衰期（秒），旧的使用记录逐渐失去权重
+DEFAULT_HALF_LIFE = 24 * 3600.0
+# 同时预生成的表情包数，避免和用户请求抢占后端
+_CONCURRENCY = 2
+# 启动后等待片刻再预生成，让出启动时的后端和网络资源
+_STARTUP_DELAY = 5.0
+# 预生成请求在生成调度中作为一个单独的群排队
+_SCHEDULER_GROUP = '__prewarm__'
+DEFAULT_POPULARITY_FILE = Path(__file__).parent.parent.parent / 'data' / 'meme_popularity.json'
+
+
+class PopularityTracker:
+    """按表情包统计使用热度（指数衰减），可持久化到磁盘以便重启后继续使用"""
+
+    def __init__(self, half_life=DEFAULT_HALF_LIFE, path=None):
+        self.half_life = half_life
+        self.path = Path(path) if path else None
+        self.counts = {}
+        self._decayed_at = time.time()
+
+    def record(self, meme_key):
+        self.counts[meme_key] = self.counts.get(meme_key, 0.0) + 1.0
+
+    def decay(self):
+        """按距上次衰减的时间衰减所有计数，并丢弃可以忽略的条目"""
+        now = time.time()
+        factor = 0.5 ** ((now - self._decayed_at) / self.half_life) if self.half_life > 0 else 1.0
+        self._decayed_at = now
+        self.counts = {key: count * factor for key, count in self.counts.items() if count * factor >= 0.01}
+
+    def top(self, limit, predicate=None):
+        """返回热度最高的 limit 个表情包key"""
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        return [key for key, _ in ranked if predicate is None or predicate(key)][:limit]
+
+    def load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text(encoding='utf-8'))
+            self.counts = {str(k): float(v) for k, v in data.get('counts', {}).items()}
+            self._decayed_at = float(data.get('decayed_at', time.time()))
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning(f"读取表情包热度失败：{repr(e)}")
+
+    def save(self):
+        """原子写入热度文件"""
+        if self.path is None:
+            return
+        try:
+            with atomic_open(self.path, 'w', encoding='utf-8') as f:
+                json.dump({'decayed_at': self._decayed_at, 'counts': self.counts}, f, ensure_ascii=False)
+        except OSError as e:
+            logger.warning(f"保存表情包热度失败：{repr(e)}")
+
+
+def is_zero_input(spec):
+    """不需要图片、可以直接用默认文本生成的表情包"""
+    return spec.max_images == 0 and (spec.min_texts == 0 or len(spec.default_texts) >= spec.min_texts)
+
+
+class Prewarmer:
+    """
+    后台预生成热门的无图片表情包（使用默认文本），结果常驻内存，
+    用户只发送关键词时直接回复，无需请求后端
+    """
+
+    def __init__(self, meme_handler, tracker=None, top_n=DEFAULT_TOP_N, max_bytes=DEFAULT_MAX_BYTES,
+                 interval=DEFAULT_INTERVAL, scheduler=None):
+        """
+        :param top_n: 预生成的表情包数，0表示关闭
+        :param max_bytes: 预生成结果占用的内存上限
+        :param interval: 重新生成的间隔（秒），0表示只在启动和目录变化时生成
+        :param scheduler: 可选的 RenderScheduler，预生成与用户请求共用后端并发上限
+        """
+        self.meme_handler = meme_handler
+        self.tracker = tracker or PopularityTracker()
+        self.top_n = top_n
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.scheduler = scheduler
+        # cache_key -> 图片数据
+        self._store = {}
+        self._size = 0
+        self._task = None
+        self._pending = None
+        self.hits = 0
+        self.cycles = 0
+        self.rendered = 0
+        self.failed = 0
+
+    def get(self, cache_key):
+        data = self._store.get(cache_key)
+        if data is not None:
+            self.hits += 1
+        return data
+
+    def record(self, meme_key):
+        """记录一次表情包使用"""
+        self.tracker.record(meme_key)
+
+    def start(self):
+        """启动后台预生成任务"""
+        if self.top_n > 0 and self._task is None:
+            self.tracker.load()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        for task in (self._task, self._pending):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._pending = None
+        if self.top_n > 0:
+            self.tracker.save()
+
+    def on_catalog_change(self, catalog):
+        """目录变化回调：模板可能已更新，重新生成"""
+        if self._task is None or (self._pending is not None and not self._pending.done()):
+            return
+        self._pending = asyncio.get_running_loop().create_task(self.warm())
+
+    async def _run(self):
+        await asyncio.sleep(_STARTUP_DELAY)
+        while True:
+            try:
+                await self.warm()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"预生成表情包失败：{repr(e)}")
+            if self.interval <= 0:
+                return
+            await asyncio.sleep(self.interval)
+
+    def _candidates(self, catalog):
+        """按热度排序的无图片表情包"""
+        memes_info = catalog.memes_info
+        return self.tracker.top(
+            self.top_n, lambda key: key in memes_info and is_zero_input(memes_info[key])
+        )
+
+    async def warm(self):
+        """生成一轮热门表情包，替换旧的预生成结果"""
+        self.tracker.decay()
+        self.tracker.save()
+        catalog = self.meme_handler.catalog
+        keys = self._candidates(catalog)
+        if not keys:
+            return
+        semaphore = asyncio.Semaphore(_CONCURRENCY)
+
+        async def render(meme_key):
+            texts = list(catalog.memes_info[meme_key].default_texts)
+            # 与用户只发送关键词时的缓存key一致
+            cache_key = make_cache_key(meme_key, texts, {}, [])
+            async with semaphore:
+                generate = lambda: self.meme_handler.generate_meme(meme_key, texts, [], {}, request_key=cache_key)
+                try:
+                    if self.scheduler is not None:
+                        data = await self.scheduler.run(_SCHEDULER_GROUP, _SCHEDULER_GROUP, generate)
+                    else:
+                        data = await generate()
+                except Exception as e:
+                    logger.debug('预生成 %s 失败：%r', meme_key, e)
+                    data = None
+            return cache_key, data
+
+        results = await asyncio.gather(*(render(key) for key in keys))
+
+        # 按热度顺序填充，超出内存上限的不再保留
+        store = {}
+        size = 0
+        for cache_key, data in results:
+            if data is None:
+                self.failed += 1
+                continue
+            self.rendered += 1
+            if size + len(data) > self.max_bytes:
+                continue
+            store[cache_key] = data
+            size += len(data)
+        self._store, self._size = store, size
+        self.cycles += 1
+        logger.info(f"已预生成 {len(store)} 个热门表情包（{size / 1024 / 1024:.1f}MB）")
+
+    def stats(self):
+        """返回预生成统计信息"""
+        return {
+            'entries': len(self._store),
+            'bytes': self._size,
+            'hits': self.hits,
+            'cycles': self.cycles,
+            'rendered': self.rendered,
+            'failed': self.failed,
+            'tracked': len(self.tracker.counts),
+        }
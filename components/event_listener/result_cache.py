@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from .storage import atomic_open
+
+logger = logging.getLogger(__name__)
+
+# 内存和磁盘两级缓存的默认容量
+DEFAULT_MEMORY_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_MAX_BYTES = 512 * 1024 * 1024
+# 磁盘缓存目录
+DEFAULT_DISK_DIR = Path(__file__).parent.parent.parent / "data" / "meme_cache"
+
+
+def make_cache_key(meme_key, texts, args, images):
+    """
+    根据表情包输入计算内容寻址的缓存key
+    :param meme_key: 表情包key
+    :param texts: 文本内容列表
+    :param args: 额外参数字典
+    :param images: 图片二进制数据列表
+    :return: 十六进制sha256摘要
+    """
+    h = hashlib.sha256()
+    payload = {
+        'key': meme_key,
+        'texts': [str(t).strip() for t in texts or []],
+        'args': args or {},
+        # 图片只参与摘要，不把原始数据放进key
+        'images': [hashlib.sha256(img).hexdigest() for img in images or []],
+    }
+    h.update(json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    return h.hexdigest()
+
+
+class _MemoryTier:
+    """内存LRU层，按总字节数限制容量"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self.evictions = 0
+
+    def get(self, key):
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._entries[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._size
+
+
+class _DiskTier:
+    """磁盘层，文件名即缓存key，按总字节数淘汰最久未访问的文件"""
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        # key -> 文件大小，顺序即访问顺序
+        self._index = OrderedDict()
+        self._size = 0
+        self.evictions = 0
+        # 读写在线程池中执行，索引修改需要加锁
+        self._lock = threading.Lock()
+        self._scan()
+
+    def _path(self, key):
+        return self.root / key[:2] / key
+
+    def _scan(self):
+        """启动时扫描已有文件，按修改时间恢复LRU顺序"""
+        if not self.root.exists():
+            return
+        files = []
+        for path in self.root.glob('*/*'):
+            if path.is_file() and not path.name.endswith('.tmp'):
+                stat = path.stat()
+                files.append((stat.st_mtime, path.name, stat.st_size))
+        for _, key, size in sorted(files):
+            self._index[key] = size
+            self._size += size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def put(self, key, data):
+        with self._lock:
+            self._put(key, data)
+
+    def _get(self, key):
+        if key not in self._index:
+            return None
+        try:
+            data = self._path(key).read_bytes()
+        except OSError:
+            self._size -= self._index.pop(key)
+            return None
+        self._index.move_to_end(key)
+        return data
+
+    def _put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        # 先写临时文件再替换，避免读到写了一半的文件
+        with atomic_open(self._path(key)) as f:
+            f.write(data)
+        old_size = self._index.pop(key, None)
+        if old_size is not None:
+            self._size -= old_size
+        self._index[key] = len(data)
+        self._size += len(data)
+        self._evict()
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def size(self):
+        return self._size
+
+
+class MemeResultCache:
+    """生成结果的两级缓存：内存LRU + 可选的磁盘存储"""
+
+    def __init__(self, memory_max_bytes=DEFAULT_MEMORY_MAX_BYTES, disk_dir=None,
+                 disk_max_bytes=DEFAULT_DISK_MAX_BYTES):
+        self.memory = _MemoryTier(memory_max_bytes)
+        self.disk = None
+        if disk_dir is not None and disk_max_bytes > 0:
+            try:
+                self.disk = _DiskTier(disk_dir, disk_max_bytes)
+            except OSError as e:
+                logger.error(f"初始化磁盘缓存失败，仅使用内存缓存：{repr(e)}")
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    async def get(self, key):
+        """查询缓存，未命中时返回None"""
+        data = self.memory.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        if self.disk is not None:
+            data = await asyncio.to_thread(self.disk.get, key)
+            if data is not None:
+                self.disk_hits += 1
+                # 回填内存层
+                self.memory.put(key, data)
+                return data
+        self.misses += 1
+        return None
+
+    async def put(self, key, data):
+        """写入缓存"""
+        if not data:
+            return
+        # 合并请求的多个等待者会写入同一结果，已缓存时跳过重复的磁盘写入
+        if self.memory.get(key) is data:
+            return
+        self.memory.put(key, data)
+        if self.disk is not None:
+            try:
+                await asyncio.to_thread(self.disk.put, key, data)
+            except OSError as e:
+                logger.error(f"写入磁盘缓存失败：{repr(e)}")
+
+    def stats(self):
+        """返回缓存统计信息"""
+        return {
+            'memory_entries': len(self.memory),
+            'memory_bytes': self.memory.size,
+            'memory_evictions': self.memory.evictions,
+            'disk_entries': len(self.disk) if self.disk is not None else 0,
+            'disk_bytes': self.disk.size if self.disk is not None else 0,
+            'disk_evictions': self.disk.evictions if self.disk is not None else 0,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from .settings import parse_key_values
+
+logger = logging.getLogger(__name__)
+
+# 默认的并发和排队上限（render_concurrency / render_queue_size / render_queue_per_group）
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_MAX_QUEUE = 64
+DEFAULT_MAX_QUEUE_PER_GROUP = 16
+
+
+class SchedulerBusyError(RuntimeError):
+    """排队的生成请求已满"""
+
+    def __init__(self):
+        super().__init__("当前生成表情包的请求太多，请稍后再试")
+
+
+class _Group:
+    """一个群的等待队列：群内按用户轮转，群之间按虚拟时间加权公平"""
+
+    __slots__ = ('weight', 'vtime', 'users', 'queued')
+
+    def __init__(self, weight, vtime):
+        self.weight = weight
+        # 虚拟完成时间，每服务一个请求增加 1/weight
+        self.vtime = vtime
+        # 用户 -> 等待中的 (future, 入队时间)
+        self.users = OrderedDict()
+        self.queued = 0
+
+
+class RenderScheduler:
+    """
+    表情包生成调度：限制同时请求后端的数量，排队的请求在群之间按权重公平分配、
+    群内按用户轮转，队列已满时直接拒绝
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, max_queue=DEFAULT_MAX_QUEUE,
+                 max_queue_per_group=DEFAULT_MAX_QUEUE_PER_GROUP, weights=None, metrics=None):
+        """
+        :param max_concurrency: 同时进行的生成请求数上限
+        :param max_queue: 排队请求总数上限
+        :param max_queue_per_group: 单个群排队请求数上限，避免一个群占满队列
+        :param weights: 群权重，{群号: 权重} 或 ['群号=权重', ...]，默认1
+        :param metrics: 可选的 Metrics，记录排队时间
+        """
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self.max_queue_per_group = max(0, int(max_queue_per_group))
+        if isinstance(weights, dict):
+            self.weights = {str(k): float(v) for k, v in weights.items()}
+        else:
+            self.weights = parse_key_values(weights, float, '群权重配置')
+        self.weights = {key: weight for key, weight in self.weights.items() if weight > 0}
+        self.metrics = metrics
+        self._active = 0
+        self._queued = 0
+        # 有请求在排队的群
+        self._groups = {}
+        # 最近一次被服务的群的虚拟时间，新进入队列的群从这里开始
+        self._vtime = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        return self._queued
+
+    async def run(self, group_id, user_id, fn):
+        """
+        获得执行名额后执行 fn()
+        :param fn: 无参协程函数
+        :return: fn 的返回值
+        :raises SchedulerBusyError: 队列已满
+        """
+        await self._acquire(str(group_id), str(user_id))
+        try:
+            return await fn()
+        finally:
+            self._release()
+
+    async def _acquire(self, group_key, user_key):
+        if self._active < self.max_concurrency and not self._queued:
+            self._active += 1
+            self.admitted += 1
+            self._observe_wait(0.0)
+            return
+
+        group = self._groups.get(group_key)
+        group_queued = group.queued if group is not None else 0
+        if self._queued >= self.max_queue or group_queued >= self.max_queue_per_group:
+            self.rejected += 1
+            if self.metrics is not None:
+                self.metrics.inc('scheduler_rejected', 'reason',
+                                 'queue_full' if self._queued >= self.max_queue else 'group_queue_full')
+            raise SchedulerBusyError()
+
+        if group is None:
+            group = self._groups[group_key] = _Group(self.weights.get(group_key, 1.0), self._vtime)
+        future = asyncio.get_running_loop().create_future()
+        group.users.setdefault(user_key, deque()).append((future, time.monotonic()))
+        group.queued += 1
+        self._queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已经拿到名额才被取消：交还名额
+                self._release()
+            else:
+                self._forget(group_key, user_key, future)
+            raise
+
+    def _forget(self, group_key, user_key, future):
+        """移除被取消的排队请求"""
+        group = self._groups.get(group_key)
+        if group is None:
+            return
+        waiters = group.users.get(user_key)
+        if not waiters:
+            return
+        for item in waiters:
+            if item[0] is future:
+                waiters.remove(item)
+                group.queued -= 1
+                self._queued -= 1
+                break
+        if not waiters:
+            del group.users[user_key]
+        if not group.users:
+            del self._groups[group_key]
+
+    def _release(self):
+        """释放名额：有请求排队时直接转交给下一个请求"""
+        while self._queued:
+            # 虚拟时间最小的群优先；权重越大，虚拟时间增长越慢，获得的份额越多
+            group_key, group = min(self._groups.items(), key=lambda item: item[1].vtime)
+            user_key, waiters = next(iter(group.users.items()))
+            future, enqueued_at = waiters.popleft()
+            # 群内用户轮转：服务过的用户排到最后
+            if waiters:
+                group.users.move_to_end(user_key)
+            else:
+                del group.users[user_key]
+            group.queued -= 1
+            self._queued -= 1
+            if not group.users:
+                del self._groups[group_key]
+            if future.done():
+                # 已被取消、但还没来得及从队列中移除的请求（如超时）：跳过，名额交给下一个
+                continue
+
+            self._vtime = group.vtime
+            group.vtime += 1.0 / group.weight
+            self.admitted += 1
+            wait = time.monotonic() - enqueued_at
+            self.max_wait = max(self.max_wait, wait)
+            self._observe_wait(wait)
+            future.set_result(None)
+            return
+        self._active -= 1
+
+    def _observe_wait(self, seconds):
+        if self.metrics is not None:
+            self.metrics.observe('queue_wait', seconds)
+
+    def stats(self):
+        """返回调度统计信息"""
+        return {
+            'active': self._active,
+            'queued': self._queued,
+            'queued_groups': len(self._groups),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'max_wait': self.max_wait,
+        }
@@ -0,0 +1,34 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_number(config, name, default, cast=float):
+    """从配置中读取数值，空值或非法值时回退到默认值"""
+    value = config.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        logger.warning(f"配置项 {name}={value!r} 无效，使用默认值 {default}")
+        return default
+
+
+def parse_key_values(entries, cast=float, name='配置'):
+    """
+    解析 ['key=value', ...] 形式的配置（如按表情包的图片尺寸、按群的调度权重）
+    :param cast: 值的类型转换，失败的条目会被跳过
+    :param name: 日志中显示的配置名
+    :return: {key: value}
+    """
+    values = {}
+    for entry in entries or []:
+        key, sep, value = str(entry).partition('=')
+        if not sep:
+            continue
+        try:
+            values[key.strip()] = cast(value)
+        except (TypeError, ValueError):
+            logger.warning(f"{name}无效：{entry}")
+    return values
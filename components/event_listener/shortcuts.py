@@ -0,0 +1,248 @@
+import logging
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+logger = logging.getLogger(__name__)
+
+# 字符集展开为首字符集合时允许的最大范围
+_MAX_RANGE_EXPAND = 64
+
+
+def _first_chars(items):
+    """
+    计算已解析正则序列可能的首字符集合
+    :return: (首字符集合或None, 是否可能匹配空串)；None表示无法确定
+    """
+    chars = set()
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            chars.add(chr(av))
+            return chars, False
+        if op is sre_parse.AT:
+            continue
+        if op is sre_parse.IN:
+            for sub_op, sub_av in av:
+                if sub_op is sre_parse.LITERAL:
+                    chars.add(chr(sub_av))
+                elif sub_op is sre_parse.RANGE and sub_av[1] - sub_av[0] <= _MAX_RANGE_EXPAND:
+                    chars.update(chr(c) for c in range(sub_av[0], sub_av[1] + 1))
+                else:
+                    return None, False
+            return chars, False
+        if op is sre_parse.SUBPATTERN:
+            sub_chars, nullable = _first_chars(av[-1])
+        elif op is sre_parse.BRANCH:
+            sub_chars, nullable = set(), False
+            for branch in av[1]:
+                branch_chars, branch_nullable = _first_chars(branch)
+                if branch_chars is None:
+                    return None, False
+                sub_chars |= branch_chars
+                nullable = nullable or branch_nullable
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            sub_chars, nullable = _first_chars(av[2])
+            nullable = nullable or av[0] == 0
+        else:
+            return None, False
+        if sub_chars is None:
+            return None, False
+        chars |= sub_chars
+        if not nullable:
+            return chars, False
+    return chars, True
+
+
+def _required_literal(items):
+    """取正则中必须出现的最长连续字面量，用于快速子串预过滤"""
+    best = ''
+    run = []
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if len(run) > len(best):
+            best = ''.join(run)
+        run = []
+        if op is sre_parse.SUBPATTERN:
+            inner = _required_literal(av[-1])
+            if len(inner) > len(best):
+                best = inner
+    if len(run) > len(best):
+        best = ''.join(run)
+    return best
+
+
+def _format_arg(arg, groups):
+    """用正则捕获组填充快捷指令参数中的 {name} 占位符"""
+    if '{' not in arg:
+        return arg
+    try:
+        return arg.format(**groups)
+    except (KeyError, IndexError, ValueError):
+        return arg
+
+
+class _Shortcut:
+    __slots__ = ('meme_key', 'regex', 'args', 'required')
+
+    def __init__(self, meme_key, regex, args, required):
+        self.meme_key = meme_key
+        self.regex = regex
+        self.args = args
+        self.required = required
+
+
+class ShortcutMatcher:
+    """
+    正则快捷指令匹配器。
+    加载时一次性编译所有正则，并按可能的首字符分桶；无法确定首字符的正则
+    用必须出现的字面量做子串预过滤。每条消息只需测试极少数候选正则。
+    """
+
+    def __init__(self, shortcuts):
+        """
+        :param shortcuts: [(meme_key, 正则字符串, 参数列表), ...]，顺序即优先级
+        """
+        self._shortcuts = []
+        # 首字符 -> 候选正则下标列表
+        self._buckets = {}
+        # 无法分桶的正则下标
+        self._unbucketed = []
+        for meme_key, pattern, args in shortcuts:
+            self._add(meme_key, pattern, args)
+
+    def _add(self, meme_key, pattern, args):
+        try:
+            regex = re.compile(pattern)
+            parsed = sre_parse.parse(pattern)
+        except (re.error, TypeError) as e:
+            logger.warning(f"快捷指令正则编译失败（{meme_key}: {pattern}）：{e}")
+            return
+
+        ignore_case = bool(parsed.state.flags & re.IGNORECASE)
+        try:
+            first, nullable = _first_chars(list(parsed))
+        except Exception:
+            first, nullable = None, True
+        index = len(self._shortcuts)
+
+        if first and not nullable:
+            self._shortcuts.append(_Shortcut(meme_key, regex, list(args or []), ''))
+            for ch in first:
+                keys = {ch, ch.lower(), ch.upper()} if ignore_case else {ch}
+                for key in keys:
+                    self._buckets.setdefault(key, []).append(index)
+        else:
+            required = '' if ignore_case else _required_literal(list(parsed))
+            self._shortcuts.append(_Shortcut(meme_key, regex, list(args or []), required))
+            self._unbucketed.append(index)
+
+    def __len__(self):
+        return len(self._shortcuts)
+
+    def _candidates(self, text):
+        bucket = self._buckets.get(text[0], ())
+        extra = [i for i in self._unbucketed if self._shortcuts[i].required in text]
+        if not extra:
+            return bucket
+        return sorted(set(bucket).union(extra))
+
+    def match(self, text):
+        """
+        匹配消息开头的快捷指令
+        :return: (meme_key, 已填充的参数列表, 剩余文本)，未匹配时返回None
+        """
+        if not text:
+            return None
+        # 与关键词一样，快捷指令必须是完整的词：匹配需结束在消息末尾或空白处，
+        # 否则 “服务器启动失败了” 这样的聊天也会被当成 “xx启动” 指令
+        token_end = len(text.split(None, 1)[0]) if text.strip() else len(text)
+        # 候选通常只有几个，取匹配最长的一个（长度相同时按优先级）
+        best, best_match = None, None
+        for index in self._candidates(text):
+            shortcut = self._shortcuts[index]
+            m = shortcut.regex.match(text)
+            if m is not None and not (m.end() == len(text) or text[m.end()].isspace()):
+                # 贪婪/非贪婪匹配可能停在词中间，再试一次整个首词
+                m = shortcut.regex.fullmatch(text, 0, token_end)
+            if m is not None and (best_match is None or m.end() > best_match.end()):
+                best, best_match = shortcut, m
+        if best is None:
+            return None
+        groups = {k: v or '' for k, v in best_match.groupdict().items()}
+        args = [_format_arg(arg, groups) for arg in best.args]
+        return best.meme_key, args, text[best_match.end():].strip()
+
+
+def _option_dest(option):
+    """按argparse的规则推导选项写入的参数名"""
+    if option.get('dest'):
+        return option['dest']
+    option_args = option.get('args') or []
+    if len(option_args) == 1 and option_args[0].get('name'):
+        return option_args[0]['name']
+    for name in option.get('names') or []:
+        if name.startswith('--'):
+            return name[2:].replace('-', '_')
+    return None
+
+
+def _convert_value(value, value_type):
+    if value_type == 'int':
+        return int(value)
+    if value_type == 'float':
+        return float(value)
+    if value_type == 'bool':
+        return str(value).lower() in ('1', 'true', 'yes', 'on')
+    return value
+
+
+def parse_shortcut_args(tokens, parser_options):
+    """
+    把快捷指令参数（命令行风格）映射为后端请求参数
+    :param tokens: 参数列表，如 ['--character', '1', '文本']
+    :param parser_options: 表情包信息中的 params_type.args_type.parser_options
+    :return: (位置参数文本列表, args字典)
+    """
+    options = {}
+    for option in parser_options or []:
+        for name in option.get('names') or []:
+            options[name] = option
+
+    texts = []
+    args = {}
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        i += 1
+        option = options.get(token)
+        if option is None:
+            if token.startswith('-') and len(token) > 1:
+                logger.warning(f"未知的快捷指令参数：{token}")
+                continue
+            texts.append(token)
+            continue
+
+        dest = _option_dest(option)
+        action = option.get('action')
+        if action is not None:
+            # store_const 类型的选项，如 --loop、--left
+            if dest:
+                args[dest] = action.get('value')
+            continue
+
+        for option_arg in option.get('args') or []:
+            if i >= len(tokens):
+                break
+            value = tokens[i]
+            i += 1
+            name = dest if len(option.get('args')) == 1 else option_arg.get('name')
+            try:
+                args[name] = _convert_value(value, option_arg.get('value'))
+            except (TypeError, ValueError):
+                logger.warning(f"快捷指令参数值无效：{token} {value}")
+    return texts, args
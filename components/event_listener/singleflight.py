@@ -0,0 +1,76 @@
+import asyncio
+
+
+class _Call:
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    合并相同key的并发请求：同一时刻只执行一次，所有等待者共享结果或异常。
+    单个等待者被取消不会影响其他等待者；所有等待者都取消后才取消底层任务。
+    """
+
+    def __init__(self):
+        self._calls = {}
+        # 被合并（未实际执行）的请求数
+        self.shared = 0
+        # 实际执行的请求数
+        self.executed = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    async def do(self, key, fn):
+        """
+        执行或加入一次调用
+        :param key: 请求的唯一标识
+        :param fn: 无参协程函数，只在没有相同key的调用进行中时执行
+        :return: fn 的返回值
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.executed += 1
+        else:
+            self.shared += 1
+
+        call.waiters += 1
+        try:
+            # shield 保证取消当前等待者时不会连带取消共享的任务
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                # 最后一个等待者离开：取消任务，并让之后的相同请求重新执行
+                call.task.cancel()
+                self._forget_key(key, call)
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _forget_key(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def _forget(self, key, call):
+        self._forget_key(key, call)
+        # 所有等待者都已离开时取走异常，避免 "exception was never retrieved" 警告
+        if not call.task.cancelled():
+            call.task.exception()
+
+    def stats(self):
+        """返回合并统计信息"""
+        return {
+            'in_flight': len(self._calls),
+            'executed': self.executed,
+            'shared': self.shared,
+        }
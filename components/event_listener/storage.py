@@ -0,0 +1,27 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def atomic_open(path, mode='wb', encoding=None):
+    """
+    原子写文件：先写同目录下的临时文件，成功后替换目标文件，
+    读取方不会看到写了一半的文件；出错时删除临时文件
+    :param mode: 'wb' 或 'w'
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # 临时文件名唯一，多个进程/线程同时写同一文件时互不覆盖
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
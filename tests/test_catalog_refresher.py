@@ -0,0 +1,65 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+
+from components.event_listener.catalog_refresher import CatalogRefresher
+from components.event_listener.meme_catalog import MemeCatalog, MemeSpec
+
+
+def _info(key):
+    return {'key': key, 'keywords': [key], 'params_type': {}, 'date_modified': '2024-01-01T00:00:00'}
+
+
+class _Handler:
+    def __init__(self, keys):
+        self.backends = SimpleNamespace(primary_url='http://meme.local')
+        self.catalog = MemeCatalog({key: MemeSpec.from_info(key, _info(key)) for key in keys})
+
+    def swap_catalog(self, catalog):
+        self.catalog = catalog
+
+
+def _refresher(backend_keys, broken, handler):
+    def handle(request):
+        path = request.url.path
+        if path == '/memes/keys':
+            return httpx.Response(200, json=backend_keys)
+        key = path.split('/')[2]
+        if key in broken:
+            return httpx.Response(404)
+        return httpx.Response(200, json=_info(key))
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+    return CatalogRefresher(handler, client, interval=600, persist=False), client
+
+
+def test_failed_key_is_not_a_catalog_change():
+    async def main():
+        handler = _Handler(['a'])
+        refresher, client = _refresher(['a', 'broken'], {'broken'}, handler)
+        notified = []
+        refresher.listeners.append(notified.append)
+        for _ in range(3):
+            assert await refresher.refresh() is False
+        await client.aclose()
+        assert refresher.change_count == 0
+        assert notified == []
+        assert refresher.stats()['failed_keys'] == 1
+
+    asyncio.run(main())
+
+
+def test_new_key_is_added_once():
+    async def main():
+        handler = _Handler(['a'])
+        refresher, client = _refresher(['a', 'b', 'broken'], {'broken'}, handler)
+        notified = []
+        refresher.listeners.append(notified.append)
+        assert await refresher.refresh() is True
+        assert await refresher.refresh() is False
+        await client.aclose()
+        assert set(handler.catalog.memes_info) == {'a', 'b'}
+        assert refresher.change_count == 1 and len(notified) == 1
+
+    asyncio.run(main())
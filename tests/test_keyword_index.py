@@ -0,0 +1,44 @@
+from components.event_listener.keyword_index import KeywordIndex, edit_distance
+
+KEYWORDS = {
+    '给社会添乱': 'add_chaos',
+    '毒瘾发作': 'addiction',
+    '安安举牌': 'acacia_anan_holdsign',
+    '举牌': 'raise_sign',
+    'ab': 'ab_meme',
+}
+
+
+def test_transposition_is_one_edit():
+    assert edit_distance('给会社添乱', '给社会添乱', 1) == 1
+    assert edit_distance('ba', 'ab', 1) == 1
+
+
+def test_resolve_swapped_pair():
+    index = KeywordIndex(KEYWORDS)
+    assert index.resolve('给会社添乱') == 'add_chaos'
+    assert index.resolve('毒瘾作发') == 'addiction'
+
+
+def test_suggest_swapped_pair_short_query():
+    index = KeywordIndex(KEYWORDS)
+    assert index.suggest('毒瘾作发', limit=1) == [('毒瘾发作', 'addiction', 1)]
+    assert index.suggest('安安牌举', limit=1) == [('安安举牌', 'acacia_anan_holdsign', 1)]
+    # 没有共享任何二元组的交换
+    assert ('ab', 'ab_meme', 1) in index.suggest('ba')
+
+
+def test_short_query_does_not_scan_every_keyword(monkeypatch):
+    from components.event_listener import keyword_index
+
+    # 500 个互不共享字符的双字关键词
+    chars = [chr(0x4e00 + i) for i in range(1000)]
+    keywords = {chars[i] + chars[i + 1]: f'meme_{i}' for i in range(0, 1000, 2)}
+    keywords['摸头'] = 'petpet'
+    index = KeywordIndex(keywords)
+
+    calls = []
+    real = keyword_index.edit_distance
+    monkeypatch.setattr(keyword_index, 'edit_distance', lambda a, b, k: calls.append(b) or real(a, b, k))
+    assert index.suggest('头摸', limit=1) == [('摸头', 'petpet', 1)]
+    assert len(calls) < 10
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from components.event_listener.scheduler import RenderScheduler, SchedulerBusyError
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def main():
+        scheduler = RenderScheduler(max_concurrency=1)
+        release = asyncio.Event()
+
+        async def running():
+            await release.wait()
+            return 'image'
+
+        first = asyncio.create_task(scheduler.run('g1', 'u1', running))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(scheduler.run('g2', 'u2', running))
+        await asyncio.sleep(0)
+        assert len(scheduler) == 1
+
+        # 同一轮事件循环中：正在运行的请求完成并释放名额，排队的请求被取消（如超时），
+        # 释放时被取消的请求还没来得及从队列中移除
+        release.set()
+        waiter.cancel()
+        assert await first == 'image'
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+        stats = scheduler.stats()
+        assert stats['active'] == 0 and stats['queued'] == 0
+
+        # 名额没有丢失，之后的请求仍能执行
+        async def quick():
+            return 'next'
+
+        assert await asyncio.wait_for(scheduler.run('g3', 'u3', quick), 1) == 'next'
+
+    asyncio.run(main())
+
+
+def test_groups_are_served_fairly():
+    async def main():
+        scheduler = RenderScheduler(max_concurrency=1, max_queue=32, max_queue_per_group=32)
+        order = []
+
+        def job(group):
+            async def fn():
+                order.append(group)
+                await asyncio.sleep(0)
+            return scheduler.run(group, 'u', fn)
+
+        tasks = [asyncio.create_task(job('a')) for _ in range(6)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(job('b')) for _ in range(2)]
+        await asyncio.gather(*tasks)
+        # 后到的群不必等刷屏的群全部完成
+        assert order.index('b') <= 2 and order[-1] == 'a'
+
+    asyncio.run(main())
+
+
+def test_rejects_when_group_queue_full():
+    async def main():
+        scheduler = RenderScheduler(max_concurrency=1, max_queue=8, max_queue_per_group=1)
+        release = asyncio.Event()
+
+        async def fn():
+            await release.wait()
+
+        tasks = [asyncio.create_task(scheduler.run('g', 'u', fn)) for _ in range(3)]
+        results = await asyncio.gather(*tasks[2:], return_exceptions=True)
+        assert isinstance(results[0], SchedulerBusyError)
+        release.set()
+        await asyncio.gather(*tasks[:2])
+        assert scheduler.stats()['rejected'] == 1
+
+    asyncio.run(main())
@@ -0,0 +1,23 @@
+from components.event_listener.shortcuts import ShortcutMatcher
+
+SHORTCUTS = [
+    ('genshin_start', r'(?P<text>\S+启动[!！]?)', ['{text}']),
+    ('lazy', r'摸+?', []),
+]
+
+
+def test_chat_sentence_containing_shortcut_is_not_matched():
+    matcher = ShortcutMatcher(SHORTCUTS)
+    assert matcher.match('服务器启动失败了') is None
+    assert matcher.match('原神启动啦啦啦 好') is None
+
+
+def test_shortcut_followed_by_text():
+    matcher = ShortcutMatcher(SHORTCUTS)
+    assert matcher.match('原神启动') == ('genshin_start', ['原神启动'], '')
+    assert matcher.match('原神启动！ 文本') == ('genshin_start', ['原神启动！'], '文本')
+
+
+def test_lazy_shortcut_matches_whole_first_word():
+    matcher = ShortcutMatcher(SHORTCUTS)
+    assert matcher.match('摸摸摸 文本') == ('lazy', [], '文本')
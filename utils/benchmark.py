@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线压测：用本地模拟的表情包后端和QQ头像服务，把合成的群消息事件送进
+DefaultEventListener 的处理函数，统计吞吐量、处理延迟和内存峰值。
+
+示例：
+    python utils/benchmark.py
+    python utils/benchmark.py --workloads text avatar --messages 2000 --concurrency 64 --latency-ms 30
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import random
+import struct
+import sys
+import time
+import tracemalloc
+import zlib
+from pathlib import Path
+
+import httpx
+
+# 脚本直接运行时需要把项目根目录加入模块搜索路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from langbot_plugin.api.entities import events  # noqa: E402
+from langbot_plugin.api.entities.builtin.platform import message as platform_message  # noqa: E402
+
+from components.event_listener.default import DefaultEventListener  # noqa: E402
+
+WORKLOADS = ('text', 'avatar', 'gif', 'fanout', 'chatter')
+
+CHATTER = [
+    '今天吃什么', '有人打游戏吗', '哈哈哈哈哈', '晚上好', '这个怎么弄啊', '我刚下班',
+    '明天几点集合', '好的收到', '笑死我了', '谁有这个链接', '周末去哪玩', '？？？',
+]
+
+
+def make_png(width, height, seed=0):
+    """生成一张纯色PNG（不依赖Pillow）"""
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    color = bytes(((seed * 37) % 256, (seed * 91) % 256, (seed * 53) % 256))
+    row = b'\x00' + color * width
+    raw = zlib.compress(row * height, 1)
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', raw) + chunk(b'IEND', b'')
+
+
+class StandInBackend:
+    """本地模拟的表情包后端和QQ头像服务（httpx MockTransport）"""
+
+    def __init__(self, latency_ms, avatar_latency_ms, payload_bytes, gif_bytes):
+        self.latency = latency_ms / 1000
+        self.avatar_latency = avatar_latency_ms / 1000
+        self.payload = b'GIF89a' + random.randbytes(max(0, payload_bytes - 6))
+        self.gif = b'GIF89a' + random.randbytes(max(0, gif_bytes - 6))
+        self.avatar = make_png(100, 100)
+        self.render_requests = 0
+        self.avatar_requests = 0
+        self.large_output = False
+
+    async def handle(self, request):
+        if request.url.host == 'q1.qlogo.cn':
+            self.avatar_requests += 1
+            await asyncio.sleep(self.avatar_latency)
+            return httpx.Response(200, content=self.avatar, headers={'content-type': 'image/png'})
+
+        path = request.url.path
+        if path == '/memes/keys':
+            return httpx.Response(200, json=[])
+        if path.startswith('/memes/') and request.method == 'POST':
+            self.render_requests += 1
+            await request.aread()
+            await asyncio.sleep(self.latency)
+            body = self.gif if self.large_output else self.payload
+            return httpx.Response(200, content=body, headers={'content-type': 'image/gif'})
+        return httpx.Response(200, json={})
+
+
+class _BenchPlugin:
+    def __init__(self, config):
+        self._config = config
+
+    def get_config(self):
+        return self._config
+
+
+class _BenchEvent:
+    def __init__(self, message_chain, sender_id, launcher_id):
+        self.message_chain = message_chain
+        self.sender_id = sender_id
+        self.launcher_id = launcher_id
+        self.launcher_type = 'group'
+
+
+class _BenchContext:
+    """最小化的 EventContext 替身，只记录回复"""
+
+    def __init__(self, event):
+        self.event = event
+        self.replies = []
+        self.prevented = False
+
+    async def reply(self, message_chain):
+        self.replies.append(message_chain)
+
+    def prevent_default(self):
+        self.prevented = True
+
+
+def _pick_memes(catalog, predicate, limit=50):
+    specs = [spec for spec in catalog.memes_info.values() if spec.keywords and predicate(spec)]
+    return specs[:limit]
+
+
+def build_messages(workload, catalog, count, rng, large_image_b64):
+    """生成一个场景的合成消息"""
+    text_memes = _pick_memes(catalog, lambda s: s.max_images == 0 and s.max_texts >= 1)
+    avatar_memes = _pick_memes(catalog, lambda s: 1 <= s.max_images <= 2 and s.min_texts == 0)
+    messages = []
+    for i in range(count):
+        sender_id = rng.randint(10000, 10400)
+        group_id = rng.randint(1, 20)
+        if workload == 'text':
+            spec = rng.choice(text_memes)
+            texts = ','.join(f'文本{rng.randint(0, 10 ** 6)}' for _ in range(max(1, spec.min_texts)))
+            chain = [platform_message.Plain(text=f'{spec.keywords[0]} {texts}')]
+        elif workload == 'avatar':
+            spec = rng.choice(avatar_memes)
+            chain = [
+                platform_message.Plain(text=f'{spec.keywords[0]} '),
+                platform_message.At(target=rng.randint(10000, 10400)),
+            ]
+        elif workload == 'fanout':
+            # 多表情包指令：同一头像渲染进3个模板
+            specs = rng.sample(avatar_memes, 3)
+            chain = [
+                platform_message.Plain(text='+'.join(spec.keywords[0] for spec in specs) + ' '),
+                platform_message.At(target=rng.randint(10000, 10400)),
+            ]
+        elif workload == 'gif':
+            spec = rng.choice(avatar_memes)
+            chain = [
+                platform_message.Plain(text=spec.keywords[0]),
+                platform_message.Image(base64=large_image_b64),
+            ]
+        else:
+            chain = [platform_message.Plain(text=rng.choice(CHATTER) + str(i % 7))]
+        messages.append(_BenchEvent(platform_message.MessageChain(chain), sender_id, group_id))
+    return messages
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+async def run_workload(handler, messages, concurrency, trace_memory):
+    """以固定并发跑完一组消息，返回统计结果"""
+    latencies = []
+    replies = 0
+    queue = list(reversed(messages))
+
+    async def worker():
+        nonlocal replies
+        while queue:
+            ctx = _BenchContext(queue.pop())
+            started = time.perf_counter()
+            await handler(ctx)
+            latencies.append(time.perf_counter() - started)
+            replies += len(ctx.replies)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    peak = 0
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'messages': len(messages),
+        'replies': replies,
+        'seconds': elapsed,
+        'msgs_per_sec': len(messages) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_mem_mb': peak / 1024 / 1024,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="表情包插件离线压测")
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument('--messages', type=int, default=1000, help="每个场景的消息数")
+    parser.add_argument('--concurrency', type=int, default=32, help="同时处理的消息数")
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="模拟后端渲染延迟")
+    parser.add_argument('--avatar-latency-ms', type=float, default=10.0, help="模拟头像下载延迟")
+    parser.add_argument('--payload-kb', type=int, default=64, help="普通表情包结果大小")
+    parser.add_argument('--gif-mb', type=float, default=4.0, help="大GIF场景的结果大小")
+    parser.add_argument('--input-px', type=int, default=1600, help="大GIF场景中用户图片的边长")
+    parser.add_argument('--backends', type=int, default=1, help="模拟的表情包后端实例数")
+    parser.add_argument('--render-concurrency', type=int, default=8, help="插件同时进行的生成请求数上限")
+    parser.add_argument('--render-queue', type=int, default=64, help="插件排队等待生成的请求数上限")
+    parser.add_argument('--with-cache', action='store_true', help="启用结果缓存（默认关闭以测量渲染路径）")
+    parser.add_argument('--no-trace-memory', action='store_true', help="不统计内存峰值（tracemalloc有额外开销）")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--stages', action='store_true', help="输出各处理阶段的延迟分布")
+    parser.add_argument('--json', action='store_true', help="以JSON输出结果")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.ERROR)
+
+    backend = StandInBackend(
+        args.latency_ms, args.avatar_latency_ms, args.payload_kb * 1024, int(args.gif_mb * 1024 * 1024)
+    )
+    config = {
+        'memeurl': ','.join(f'http://meme-backend-{i}.local' for i in range(max(1, args.backends))),
+        'catalog_refresh_interval': 0,
+        # 预生成会读写 data/meme_popularity.json，压测时关闭
+        'prewarm_top_n': 0,
+        'result_cache_memory_mb': 64 if args.with_cache else 0,
+        'max_response_mb': max(10, args.gif_mb * 2),
+        'render_concurrency': args.render_concurrency,
+        'render_queue_size': args.render_queue,
+        'render_queue_per_group': args.render_queue,
+    }
+
+    DefaultEventListener.http_transport = httpx.MockTransport(backend.handle)
+    listener = DefaultEventListener()
+    listener.plugin = _BenchPlugin(config)
+    await listener.initialize()
+    handler = listener.registered_handlers[events.GroupMessageReceived][0]
+    catalog = listener.meme_handler.catalog
+    large_image_b64 = 'data:image/png;base64,' + base64.b64encode(
+        make_png(args.input_px, args.input_px, seed=3)
+    ).decode('ascii')
+
+    results = {}
+    try:
+        for workload in args.workloads:
+            messages = build_messages(workload, catalog, args.messages, rng, large_image_b64)
+            backend.large_output = workload == 'gif'
+            # 每个场景单独统计各阶段耗时
+            listener.metrics.stages.clear()
+            listener.metrics.counters.clear()
+            results[workload] = await run_workload(
+                handler, messages, args.concurrency, not args.no_trace_memory
+            )
+            snapshot = listener.metrics.snapshot()
+            results[workload]['stages'] = snapshot['stages']
+            results[workload]['errors'] = snapshot['counters'].get('errors', {})
+    finally:
+        await listener.close()
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+
+    print(f"{'场景':<8}{'消息数':>8}{'回复数':>8}{'msgs/s':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'峰值内存(MB)':>14}")
+    for workload, r in results.items():
+        print(f"{workload:<10}{r['messages']:>8}{r['replies']:>8}{r['msgs_per_sec']:>10.1f}"
+              f"{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['peak_mem_mb']:>14.2f}")
+    if args.stages:
+        for workload, r in results.items():
+            print(f"\n[{workload}] {'阶段':<8}{'次数':>8}{'p50(ms)':>10}{'p90(ms)':>10}{'p99(ms)':>10}")
+            for stage, h in r['stages'].items():
+                print(f"{'':<{len(workload) + 3}}{stage:<10}{h['count']:>8}{h['p50'] * 1000:>10.2f}"
+                      f"{h['p90'] * 1000:>10.2f}{h['p99'] * 1000:>10.2f}")
+            if r['errors']:
+                print(f"{'':<{len(workload) + 3}}错误：{r['errors']}")
+    print(f"后端渲染请求 {backend.render_requests} 次，头像请求 {backend.avatar_requests} 次")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,70 +1,108 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
 import asyncio
-import json
+import os
+import sys
 import yaml
 from pathlib import Path
 
 import httpx
 
+# 复用插件的快照格式和抓取逻辑，脚本直接运行时需要把项目根目录加入模块搜索路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from components.event_listener.catalog_fetcher import (  # noqa: E402
+    DEFAULT_CONCURRENCY,
+    DEFAULT_RETRIES,
+    refresh_catalog,
+)
+from components.event_listener.meme_catalog import (  # noqa: E402
+    SNAPSHOT_FILE,
+    MemeSpec,
+    save_yaml,
+    write_snapshot,
+)
+
 MEME_API_URL = "http://127.0.0.1:2233"
 OUTPUT_FILE = Path(__file__).parent.parent / "data" / "memes_info.yaml"
 
 
-async def fetch_all_meme_keys():
-    """获取所有表情包的key"""
-    url = f"{MEME_API_URL}/memes/keys"
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url)
-        resp.raise_for_status()
-        return resp.json()
+def parse_args():
+    parser = argparse.ArgumentParser(description="获取表情包信息并保存到yaml文件（key一级格式）")
+    parser.add_argument('--url', default=os.environ.get('MEME_API_URL', MEME_API_URL),
+                        help=f"表情包后端地址（默认 {MEME_API_URL}，也可用环境变量 MEME_API_URL 指定）")
+    parser.add_argument('--output', type=Path, default=OUTPUT_FILE, help="输出的yaml文件路径")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help="并发请求数")
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help="单个请求的最大重试次数")
+    parser.add_argument('--timeout', type=float, default=30.0, help="单个请求的超时秒数")
+    parser.add_argument('--incremental', action='store_true',
+                        help="增量模式：只获取新增的表情包，删除后端已移除的表情包")
+    parser.add_argument('--revalidate', action='store_true',
+                        help="增量模式下重新获取已有表情包，按 date_modified 报告有变化的条目")
+    return parser.parse_args()
+
+
+def load_existing(path):
+    """读取现有的表情包信息文件"""
+    if not path.exists():
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}
 
 
-async def fetch_meme_info(key):
-    """获取单个表情包的详细信息"""
-    url = f"{MEME_API_URL}/memes/{key}/info"
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url)
-        resp.raise_for_status()
-        return resp.json()
+def print_progress(done, total, key, error):
+    if error is not None:
+        print(f"获取表情包 {key} 信息失败 ({done}/{total}): {str(error)}")
+    else:
+        print(f"已获取表情包信息 ({done}/{total}): {key}")
 
 
 async def main():
     """主函数：获取所有表情包信息并保存到yaml文件（key一级格式）"""
+    args = parse_args()
+    base_url = args.url.rstrip('/')
     try:
         # 确保输出目录存在
-        OUTPUT_FILE.parent.mkdir(parents=True, exist_ok=True)
-        
-        # 获取所有表情包的key
-        print("正在获取所有表情包的key...")
-        meme_keys = await fetch_all_meme_keys()
-        print(f"共获取到 {len(meme_keys)} 个表情包的key")
-        
-        # 获取每个表情包的详细信息并构建key一级格式的字典
-        memes_info_dict = {}
-        for i, key in enumerate(meme_keys, 1):
-            print(f"正在获取表情包信息 ({i}/{len(meme_keys)}): {key}")
-            try:
-                meme_info = await fetch_meme_info(key)
-                # 创建一个新字典，不包含key字段（如果存在）
-                if 'key' in meme_info:
-                    del meme_info['key']
-                # 将信息保存到字典中，key作为顶级键
-                memes_info_dict[key] = meme_info
-            except Exception as e:
-                print(f"获取表情包 {key} 信息失败: {str(e)}")
-        
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+
+        existing = load_existing(args.output)
+        if args.incremental:
+            print(f"增量模式：现有 {len(existing)} 个表情包信息")
+
+        print(f"正在从 {base_url} 获取表情包信息...")
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+            memes_info_dict, report = await refresh_catalog(
+                client, base_url,
+                existing=existing,
+                incremental=args.incremental,
+                revalidate=args.revalidate,
+                concurrency=args.concurrency,
+                retries=args.retries,
+                progress=print_progress,
+            )
+
         # 保存到yaml文件（key一级格式）
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            yaml.dump(memes_info_dict, f, allow_unicode=True, default_flow_style=False)
-        
-        print(f"表情包信息已保存到: {OUTPUT_FILE}")
-        print(f"成功获取了 {len(memes_info_dict)} 个表情包的详细信息")
-        
+        save_yaml(memes_info_dict, args.output)
+        print(f"表情包信息已保存到: {args.output}")
+
+        # 同时写入二进制快照，插件启动时无需再解析YAML
+        if args.output == OUTPUT_FILE:
+            specs = {key: MemeSpec.from_info(key, info) for key, info in memes_info_dict.items()}
+            write_snapshot(specs, SNAPSHOT_FILE, args.output)
+            print(f"表情包信息快照已保存到: {SNAPSHOT_FILE}")
+
+        print(f"共 {report['total']} 个表情包，本次获取 {report['fetched']} 个")
+        print(f"新增 {len(report['added'])} 个，更新 {len(report['changed'])} 个，"
+              f"移除 {len(report['removed'])} 个，失败 {len(report['errors'])} 个")
+        if report['changed']:
+            print(f"有变化的表情包: {', '.join(report['changed'])}")
+
     except Exception as e:
         print(f"发生错误: {str(e)}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())